@@ -1,9 +1,14 @@
 #!/usr/bin/env python
 
-from os.path import join
+import sys
+from os.path import abspath, dirname, join
 import time
 from psychopy import core, event, logging, visual
 from mvpa2.base.hdf5 import h5load, h5save
+sys.path.append(join(dirname(abspath(__file__)), '..', 'experiment'))
+from event_log import start_event_log, log_event, stop_event_log
+from thumbnail_atlas import load_atlas, thumbnail, contains, draw_thumbnails
+from hit_grid import grid_from_items, move_item, item_at
 
 participant = 1
 session = 1
@@ -16,8 +21,10 @@ subsets = h5load('arrangements/starting_arrangements_n{0}_r{1}_p{2}_s{3}.hdf5'.f
 clock = core.Clock()
 logging.setDefaultClock(clock)
 log = logging.LogFile(f=join('logs', 'arrangement_log_p{0}_s{1}.txt'.format(
-                participant, session)), level=logging.DATA,
+                participant, session)), level=logging.WARNING,
                 filemode='w')
+events = start_event_log(join('logs', 'arrangement_events_p{0}_s{1}.tsv'.format(
+                participant, session)), clock.getTime)
 
 win = visual.Window(size=(1920, 1200), color=(0, 0, 0), fullscr=True,
                     screen=1, units='pix')
@@ -56,12 +63,14 @@ quit_prompt = visual.TextStim(win, text=("Are you sure you want to quit? "
                                          "(press 'y' or 'n')"),
                               wrapWidth=950, name="Quit?")
 quit_prompt.height = 36
-loading = visual.TextStim(win, text=("Loading..."),
-                          wrapWidth=950, name="Loading")
-loading.height = 36
 
 mouse = event.Mouse()
 
+# Load every image in the session into one texture while the instructions
+# are shown, so subsets start without loading
+atlas = load_atlas({stimulus: join('stimuli', 'frames', stimulus + '_cropped_frame_001.png')
+                    for subset in subsets for stimulus, start_position in subset})
+
 start = False
 while not start:
     instructions.draw()
@@ -70,6 +79,8 @@ while not start:
     if 'space' in keys or 'enter' in keys:
         start = True
     if 'q' in keys or 'escape' in keys:
+        log_event(events, 'quit')
+        stop_event_log(events)
         win.close()
         core.quit()
 
@@ -78,59 +89,55 @@ radius = 500
 arena = visual.Circle(win, radius=(radius, radius), units='pix', edges=100,
                       lineWidth=10.0, interpolate=True)
 
-logging.data("Starting experiment!")
+log_event(events, 'start')
 results = {}
 for subset_i, subset in enumerate(subsets):
-    loading.draw()
-    arena.draw()
-    win.flip()
-
     starting_positions = {stimulus: [s * (radius + 60) for s in start_position]
                           for stimulus, start_position in subset}
 
-    frames = {stimulus: visual.ImageStim(win, image=join('stimuli', 'frames',
-                                              stimulus + '_cropped_frame_001.png'),
-                               size=(72, 72), units='pix',
-                               pos=[s * (radius + 60) for s in start_position],
-                               name=stimulus)
+    frames = {stimulus: thumbnail(stimulus, [s * (radius + 60) for s in start_position],
+                                  (72, 72))
               for stimulus, start_position in subset}
 
-    for frame in frames.values():
-        frame.draw()
-    win.flip()
-    logging.data("Finished drawing images, starting trial {0}!".format(subset_i))
+    log_event(events, 'trial_start', value=subset_i)
 
+    # All images are drawn from the atlas in one batch, the dragged one last;
+    # the grid finds the topmost image under the mouse
+    grid = grid_from_items(frames.items())
     finished = False
     while not finished:
         arena.draw()
-        for frame in frames.values():
-            frame.draw()
+        draw_thumbnails(win, atlas, list(frames.values()))
         win.flip()
 
-        for stimulus, frame in frames.items():
-            while mouse.isPressedIn(frame, buttons=[0]):
+        buttons = mouse.getPressed()
+        stimulus = item_at(grid, mouse.getPos()) if any(buttons) else None
+        if stimulus is not None:
+            frame = frames[stimulus]
+
+        if stimulus is not None and buttons[0]:
+            others = [other_frame for other_stimulus, other_frame in frames.items()
+                      if other_stimulus != stimulus]
+            while mouse.getPressed()[0] and contains(frame, mouse.getPos()):
                 position = mouse.getPos()
-                frame.pos = position
+                frame['pos'] = position
+                arena.draw()
+                draw_thumbnails(win, atlas, others + [frame])
+                win.flip()
+            move_item(grid, stimulus)
+
+        elif stimulus is not None and buttons[2]:
+            clip = visual.MovieStim(win, filename=join('stimuli', 'clips',
+                                                       stimulus + '_final.mp4'),
+                                    size=(256, 144), pos=frame['pos'], name='Clip')
+            start_time = time.time()
+            clip.play()
+            log_event(events, 'play', stimulus=stimulus)
+            while time.time() - start_time <= 2.5:
                 arena.draw()
-                frame.draw()
-                for other_stimulus, other_frame in frames.items():
-                    if other_stimulus != stimulus:
-                        other_frame.draw()
+                draw_thumbnails(win, atlas, list(frames.values()))
+                clip.draw()
                 win.flip()
-       
-        for stimulus, frame in frames.items(): 
-            if mouse.isPressedIn(frame, buttons=[2]):
-                clip = visual.MovieStim(win, filename=join('stimuli', 'clips',
-                                                           stimulus + '_final.mp4'),
-                                        size=(256, 144), pos=frame.pos, name='Clip')
-                start_time = time.time()
-                clip.play()
-                while time.time() - start_time <= 2.5:
-                    arena.draw()
-                    for frame in frames.values():
-                        frame.draw()
-                    clip.draw()
-                    win.flip()
 
         keys = event.getKeys()
         if 'space' in keys or 'enter' in keys:
@@ -146,8 +153,8 @@ for subset_i, subset in enumerate(subsets):
                     for name, stimulus in frames.items():
                         results[subset_i][name] = {}
                         results[subset_i][name]['start'] = starting_positions[name]
-                        results[subset_i][name]['finish'] = stimulus.pos.tolist()
-                    logging.data("Done trial {0}, recorded results!".format(subset_i))
+                        results[subset_i][name]['finish'] = stimulus['pos'].tolist()
+                    log_event(events, 'trial_done', value=subset_i)
                     responded = True
                     finished = True
                     
@@ -162,10 +169,12 @@ for subset_i, subset in enumerate(subsets):
                 if 'y' in keys:
                     h5save('arrangements/final_arrangements_n{0}_r{1}_p{2}_s{3}.hdf5'.format(
                                 subset_size, n_subsets, participant, session), results)
+                    log_event(events, 'quit')
+                    stop_event_log(events)
                     win.close()
                     core.quit()
 
-logging.data("Completed experiment, saving results!")
+log_event(events, 'complete')
 complete = visual.TextStim(win, text=("Experiment complete. Thanks!"),
                           wrapWidth=950, name="Complete")
 complete.height = 36
@@ -180,5 +189,7 @@ while not end_experiment:
     win.flip()
     keys = event.getKeys()
     if 'q' in keys or 'escape' in keys:
+        log_event(events, 'quit')
+        stop_event_log(events)
         win.close()
         core.quit()
@@ -5,16 +5,21 @@
 
 # Optionally supply DBIC ID, accession number, and participant number:
 #   python actions_presentation.py <DBIC ID> <accession number> <participant_number>
-# Command line arguments must be in order!
+# Command line arguments must be in order! A serial device other than
+# /dev/ttyUSB0 (e.g., from fake_serial_device.py) can follow them
 
 import sys
-import time
-import serial
 import multiprocessing
-from os.path import exists, join
+from os.path import basename, exists, join
 from psychopy import core, event, gui, logging, visual
 from psychopy.hardware.emulator import launchScan
-from mvpa2.base.hdf5 import h5load, h5save
+from trial_order_store import load_run, fixation as fixation_stimulus, question as question_stimulus
+from movie_prefetch import (decode_clip, start_prefetch, stop_prefetch, next_clip,
+                            load_clip_texture, draw_clip, release_clip)
+from frame_cache import load_frame_index, load_cached_clip
+from flip_schedule import measure_frame_duration, event_flips, flip_index
+from serial_reader import start_serial_reader, drain_serial, stop_serial_reader
+from event_log import start_event_log, log_event, stop_event_log
 
 # Set up GUI for inputing participant/run information (with defaults)
 if len(sys.argv) > 1:
@@ -43,24 +48,52 @@ if run_configuration.OK:
 elif not run_configuration.OK:
     core.quit()
 
-# Start PsychoPy's clock (mostly for logging)
-run_clock = core.Clock()
-
-# Set up PsychoPy's logging function
-logging.setDefaultClock(run_clock)
+# Set up PsychoPy's logging function for its own warnings only. Its
+# default clock is left as core.getTime's, which win.flip, event.getKeys
+# and the serial reader also stamp with, so all run times share one clock
 log = logging.LogFile(f=join('logs', 'log_p{0}_s{1}_r{2}.txt'.format(
-                participant, session, run)), level=logging.INFO,
+                participant, session, run)), level=logging.WARNING,
                 filemode='w')
 
+# Log events to logs/events_p{p}_s{s}_r{r}.tsv in seconds since the start,
+# then since the first scanner trigger once it arrives
+run_start = core.getTime()
+events = start_event_log(join('logs', 'events_p{0}_s{1}_r{2}.tsv'.format(
+                participant, session, run)), lambda: core.getTime() - run_start)
+
 # Load in events / trial order
-trials = h5load(join('trial_orders',
-                     'trial_order_p{0}_s{1}_r{2}.hdf5'.format(
-                         participant, session, run)))
+trials, stimuli, verbs = load_run(join('trial_orders', 'trial_orders.npz'),
+                                  participant, session, run)
 assert len(trials) == 100 + 3
 
+# Start loading the run's clips in the background, a few clips ahead, from
+# the frame cache (built with frame_cache.py) or else by decoding them
+clip_fns = [join('stimuli', stimuli[stimulus]) for stimulus in trials['stimulus']
+            if stimulus != fixation_stimulus and stimulus != question_stimulus]
+cache_dir = 'frame_cache'
+frame_index = load_frame_index(cache_dir)
+if all(basename(clip_fn) in frame_index for clip_fn in clip_fns):
+    load = lambda clip_fn: load_cached_clip(frame_index, cache_dir, clip_fn)
+else:
+    no_cache = "Frame cache is missing clips, decoding them during the run"
+    log_event(events, 'frame_cache_missing')
+    print(no_cache)
+    load = lambda clip_fn: decode_clip(clip_fn, 720)
+prefetch = start_prefetch(clip_fns, load)
+
 # Open window and wait for first scanner trigger
 win = visual.Window([1280, 1024], screen=1, fullscr=True, color=0, name='Window')
 
+# Measure the refresh rate and find the flips each trial starts and stops on
+frame_duration, measured = measure_frame_duration(win)
+if not measured:
+    no_rate = "Could not measure the refresh rate, assuming {0} s per flip".format(frame_duration)
+    log_event(events, 'refresh_rate_unmeasured')
+    print(no_rate)
+log_event(events, 'frame_duration', value=frame_duration)
+trial_starts, trial_stops = event_flips(trials['onset'], frame_duration, 2.5)
+end_flip = int(round(535. / frame_duration))
+
 instructions = visual.TextStim(win, pos=[-.9, .9], wrapWidth=1.8,
         alignHoriz='left', alignVert='top', name='Instructions',
                 text=("Watch the following clips and pay attention "
@@ -90,13 +123,14 @@ instructions_wait = True
 while instructions_wait:
     keys = event.getKeys()
     if 'space' in keys or 'return' in keys:
-        logging.info("Finished instructions")
+        log_event(events, 'instructions_done')
         instructions_wait = False
     if 'q' in keys or 'escape' in keys:
         quitting = ('Quit command ("q" or "escape") was detected! '
                     'Quitting experiment')
-        logging.info(quitting)
+        log_event(events, 'quit')
         print(quitting)
+        stop_event_log(events)
         win.close()
         core.quit()
     
@@ -105,11 +139,11 @@ waiting = visual.TextStim(win, pos=[0, 0], text="Waiting for scanner...",
 waiting.draw()
 win.flip()
 
-serial_path = '/dev/ttyUSB0'
+serial_path = sys.argv[4] if len(sys.argv) > 4 else '/dev/ttyUSB0'
 if not exists(serial_path):
     serial_exists = False
     no_serial = "No serial device detected, using keyboard"
-    logging.info(no_serial)
+    log_event(events, 'serial_device', value='none')
     print(no_serial)
     scanner_wait = True
     while scanner_wait:
@@ -117,130 +151,166 @@ if not exists(serial_path):
         win.flip()
         keys = event.getKeys()
         if '5' in keys:
+            trigger_time = core.getTime()
             scanner_wait = False
         if 'q' in keys or 'escape' in keys:
             quitting = ('Quit command ("q" or "escape") was detected! '
                         'Quitting experiment')
-            logging.info(quitting)
+            log_event(events, 'quit')
             print(quitting)
+            stop_event_log(events)
             win.close()
             core.quit()
 elif exists(serial_path):
     serial_exists = True
     found_serial = "Serial device detected"
-    logging.info(found_serial)
+    log_event(events, 'serial_device', value=serial_path)
     print(found_serial)
-    ser = serial.Serial(serial_path, 115200, timeout=.0001)
-    ser.flushInput()
-    while ser.read() != '5':
+    # The reader owns the port for the whole run, stamping each byte as it
+    # arrives, so the run starts from the trigger's arrival
+    reader = start_serial_reader(serial_path, get_time=core.getTime)
+    trigger_time = None
+    while trigger_time is None:
         waiting.draw()
         win.flip()
+        for byte_time, byte in drain_serial(reader):
+            if byte == '5':
+                trigger_time = byte_time
+                break
+        keys = event.getKeys()
         if 'q' in keys or 'escape' in keys:
             quitting = ('Quit command ("q" or "escape") was detected! '
                         'Quitting experiment')
-            logging.info(quitting)
+            log_event(events, 'quit')
             print(quitting)
+            stop_event_log(events)
             win.close()
             core.quit()
-    ser.close()
 
-# Set run start time and reset PsychoPy's core.Clock() on first trigger
-first_trigger = "Got first scanner trigger! Resetting clocks"
-run_start = time.time()
-run_clock.reset()
-logging.info(first_trigger)
+# Flips and events are timed from the first trigger
+run_start = trigger_time
+log_event(events, 'run_start', value=run_start, time=0.)
 
 # Start fixation after scanner trigger
 fixation = visual.TextStim(win, pos=(0, 0), text="+", name="Fixation")
 fixation.draw()
-win.flip()
+fixation_flip = win.flip()
 
-# Start looping through trials
-for trial in trials:
-    onset = trial[0]
+# Loop over flips, drawing the trial each flip falls in (fixation between
+# trials) and preparing the next trial's stimulus while waiting for it
+trial_i = 0
+prepared, started = False, False
+clip = None
+offset = None
+flip_i = flip_index(fixation_flip - run_start, frame_duration) + 1
+while flip_i < end_flip:
+    if trial_i < len(trials) and flip_i >= trial_stops[trial_i]:
+        # The trial ends on the next flip; log it with its scheduled time
+        if started:
+            offset = (name, trial_stops[trial_i] * frame_duration)
+        if clip is not None:
+            release_clip(clip)
+            clip = None
+        trial_i += 1
+        prepared, started = False, False
+        continue
+    if trial_i < len(trials):
+        trial = trials[trial_i]
+        stimulus = trial['stimulus']
+        showing = flip_i >= trial_starts[trial_i]
+    else:
+        stimulus = fixation_stimulus
+        showing = False
 
-    loaded_clip = False
-    if serial_exists:
-        ser = serial.Serial(serial_path, 115200, timeout=.0001)
-        ser.flushInput()
-        
-    while time.time() - run_start < onset:
-        fixation.draw()
-        win.flip()
-        
-        if serial_exists:
-            serial_input = ser.read()
-            if len(list(serial_input)) > 0:
-                if '5' in serial_input:
-                    logging.info('Scanner trigger received')
-                if '1' in serial_input:
-                    logging.data('Serial response 1')
-                if '2' in serial_input:
-                    logging.data('Serial response 2')
-
-        keys = event.getKeys(timeStamped=run_clock)
-        for key in keys:
-            logging.data(key)
-            if key[0] == '5':
-                logging.info('Scanner trigger received from keyboard')
-            if key[0] in ('q', 'escape'):
-                quitting = ('Quit command ("q" or "escape") was detected! '
-                            'Quitting experiment')
-                logging.info(quitting)
-                print(quitting)
-                win.close()
-                core.quit()
-
-        if trial[2] != 'fixation' and trial[2] != 'question' and not loaded_clip:
-            clip_fn = join('stimuli', trial[2])
-            clip = visual.MovieStim2(win, clip_fn, size=720,
-                                     pos=(0, 0), flipVert=False,
-                                     flipHoriz=False, loop=False,
-                                     noAudio=True, name=trial[2])
-            loaded_clip = True
-    
-    trial_start = time.time()
-    if trial[2] == 'fixation':
-        while time.time() - trial_start <= 2.5:
-            fixation.draw()
-            win.flip()
-
-    elif trial[2] == 'question':
-        #question = visual.TextStim(win, text=question_text, pos=(0, .25), alignHoriz='center',
-        #                           alignVert='bottom', wrapWidth=2, name='Question')
-        probe_left = visual.TextStim(win, text='"'+trial[3][0]+'"', pos=(-.35, 0),
-                                     alignHoriz='center', alignVert='center',
-                                     name='Left probe: "{0}"'.format(trial[3][0]))
-        probe_right = visual.TextStim(win, text='"'+trial[3][1]+'"', pos=(.35, 0),
-                                      alignHoriz='center', alignVert='center',
-                                      name='Right probe: "{0}"'.format(trial[3][1]))
-        while time.time() - trial_start <= 2.5:
-            #question.draw()
-            probe_left.draw()
-            probe_right.draw()
-            win.flip()
+    # Take the clip from the prefetch queue once it is loaded and upload its
+    # first frame, or make the probes, during the preceding fixation flips;
+    # only block if the clip is still not loaded when it is due
+    if trial_i < len(trials) and not prepared:
+        if stimulus == question_stimulus:
+            probe = [verbs[verb] for verb in trial['probe']]
+            #question = visual.TextStim(win, text=question_text, pos=(0, .25), alignHoriz='center',
+            #                           alignVert='bottom', wrapWidth=2, name='Question')
+            probe_left = visual.TextStim(win, text='"'+probe[0]+'"', pos=(-.35, 0),
+                                         alignHoriz='center', alignVert='center',
+                                         name='Left probe: "{0}"'.format(probe[0]))
+            probe_right = visual.TextStim(win, text='"'+probe[1]+'"', pos=(.35, 0),
+                                          alignHoriz='center', alignVert='center',
+                                          name='Right probe: "{0}"'.format(probe[1]))
+            prepared = True
+        elif stimulus != fixation_stimulus:
+            clip_fn = join('stimuli', stimuli[stimulus])
+            clip = next_clip(prefetch, clip_fn, block=False)
+            if clip is None and showing:
+                log_event(events, 'clip_late', stimulus=clip_fn)
+                clip = next_clip(prefetch, clip_fn)
+            if clip is not None:
+                load_clip_texture(clip)
+                prepared = True
+        else:
+            prepared = True
 
+    if not showing or stimulus == fixation_stimulus:
+        fixation.draw()
+    elif stimulus == question_stimulus:
+        #question.draw()
+        probe_left.draw()
+        probe_right.draw()
     else:
-        # Play video for 2.5 s with Psychopy's suggested CPU break
-        shouldflip = clip.play()
-        while time.time() - trial_start <= 2.5:
-            if shouldflip:
-                # Movie has already been drawn , so just draw text stim and flip
-                win.flip()
-            else:
-                # Give the OS a break if a flip is not needed
-                time.sleep(0.001)
-                # Drawn movie stim again. Updating of movie stim frames as necessary
-                # is handled internally.
-            shouldflip = clip.draw()
-
-while time.time() - run_start <= 535.:
-    fixation.draw()
-    win.flip()
+        # Draw the prefetched frame due at this flip
+        draw_clip(win, clip, (flip_i - trial_starts[trial_i]) * frame_duration)
+    # win.flip returns the time of the flip itself (on logging.defaultClock,
+    # which is core.getTime's)
+    flip_time = win.flip() - run_start
+
+    # Flip times with the scheduled times as their values
+    if offset is not None:
+        log_event(events, 'offset', stimulus=offset[0], value=offset[1], time=flip_time)
+        offset = None
+
+    if showing and not started:
+        started = True
+        if stimulus == fixation_stimulus:
+            name = "fixation"
+        elif stimulus == question_stimulus:
+            name = "question"
+        else:
+            name = clip_fn
+        log_event(events, 'onset', stimulus=name,
+                  value=trial_starts[trial_i] * frame_duration, time=flip_time)
+
+    # Log triggers and responses with their arrival times since the trigger
+    if serial_exists:
+        for byte_time, byte in drain_serial(reader):
+            if byte == '5':
+                log_event(events, 'trigger', time=byte_time - run_start)
+            if byte in ('1', '2'):
+                log_event(events, 'response', value=byte, time=byte_time - run_start)
+
+    # Key presses are stamped on core.getTime, like the flips and serial bytes
+    keys = event.getKeys(timeStamped=True)
+    for key in keys:
+        log_event(events, 'key', value=key[0], time=key[1] - run_start)
+        if key[0] in ('q', 'escape'):
+            quitting = ('Quit command ("q" or "escape") was detected! '
+                        'Quitting experiment')
+            log_event(events, 'quit')
+            print(quitting)
+            stop_event_log(events)
+            win.close()
+            core.quit()
+
+    # A dropped frame skips a flip index rather than delaying what follows
+    flip_i = flip_index(flip_time, frame_duration) + 1
+
+if serial_exists:
+    stop_serial_reader(reader)
+
+stop_prefetch(prefetch)
 
 finished = "Finished run successfully!"
-logging.info(finished)
+log_event(events, 'run_end')
 print(finished)
 
+stop_event_log(events)
 win.close()
 core.quit()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+# Adaptive item subsets for multi-arrangement sessions, after the
+# lift-the-weakest method of Kriegeskorte & Mur (2012). Each finished
+# arrangement gives on-screen distances for the pairs it contained; the
+# running RDM estimate is their evidence-weighted average, with every
+# arrangement rescaled to fit the estimate (iterated until it settles). A
+# pair's evidence from a trial is its distance squared relative to the
+# trial's largest distance, as pairs placed close together are placed least
+# reliably. The next subset starts from the pair with the least evidence
+# and greedily adds the item that most increases the utility of the
+# evidence gained, up to the session's subset size; smaller subsets, as in
+# the original method, are hard to scale against the estimate and cost
+# reliability. Sessions end once the median pair has target_evidence.
+
+import numpy as np
+
+# Utility of evidence w is 1 - exp(-utility_rate * w), so gains diminish
+utility_rate = .5
+
+# Stop once the median pair has this much evidence (12 random subsets of 30
+# after a full arrangement reach about .25)
+target_evidence = .25
+
+
+def new_estimate(stimuli):
+    """Running estimate over all stimuli, from no arrangements yet"""
+    return {'stimuli': list(stimuli),
+            'index': {stimulus: i for i, stimulus in enumerate(stimuli)},
+            'trials': []}
+
+
+def add_arrangement(estimate, positions):
+    """Add a finished arrangement, given as a dict of stimulus to position"""
+    stimuli = sorted(positions)
+    items = np.array([estimate['index'][stimulus] for stimulus in stimuli])
+    xy = np.array([positions[stimulus] for stimulus in stimuli], dtype=float)
+    distances = np.sqrt(np.sum((xy[:, np.newaxis] - xy[np.newaxis]) ** 2, axis=-1))
+    estimate['trials'].append((items, distances))
+
+
+def trial_evidence(distances):
+    return (distances / distances.max()) ** 2
+
+
+def estimate_rdm(estimate, n_iterations=100, tolerance=1e-6):
+    """Evidence-weighted RDM (RMS of 1 over estimated pairs, NaN for pairs
+    not arranged yet) and the evidence for each pair"""
+    n_stimuli = len(estimate['stimuli'])
+    evidence = np.zeros((n_stimuli, n_stimuli))
+    for items, distances in estimate['trials']:
+        evidence[np.ix_(items, items)] += trial_evidence(distances)
+    arranged = evidence > 0
+
+    # Start from each arrangement scaled to an RMS distance of 1
+    scales = [1. / np.sqrt(np.mean(distances[np.triu_indices(len(items), 1)] ** 2))
+              for items, distances in estimate['trials']]
+    rdm = np.full((n_stimuli, n_stimuli), np.nan)
+    for iteration in range(n_iterations):
+        total = np.zeros((n_stimuli, n_stimuli))
+        for (items, distances), scale in zip(estimate['trials'], scales):
+            total[np.ix_(items, items)] += trial_evidence(distances) * scale * distances
+        previous = rdm
+        rdm = np.full((n_stimuli, n_stimuli), np.nan)
+        rdm[arranged] = total[arranged] / evidence[arranged]
+        rdm /= np.sqrt(np.nanmean(rdm[np.triu_indices(n_stimuli, 1)] ** 2))
+        np.fill_diagonal(rdm, 0)
+        if iteration and np.nanmax(np.abs(rdm - previous)) < tolerance:
+            break
+
+        # Rescale each arrangement to fit the estimate (weighted least squares)
+        scales = []
+        for items, distances in estimate['trials']:
+            weights = trial_evidence(distances)
+            target = rdm[np.ix_(items, items)]
+            scales.append(np.sum(weights * target * distances) /
+                          np.sum(weights * distances ** 2))
+    return rdm, evidence
+
+
+def utility(evidence):
+    return 1 - np.exp(-utility_rate * evidence)
+
+
+def subset_gain(rdm, evidence, items):
+    """Utility gained by arranging items, taking the current estimate as
+    their anticipated arrangement"""
+    block = np.ix_(items, items)
+    distances = rdm[block]
+    if not distances.max() > 0:
+        return 0.
+    gain = utility(evidence[block] + trial_evidence(distances)) - utility(evidence[block])
+    return np.sum(np.triu(gain, 1))
+
+
+def select_subset(estimate, size, rng):
+    """Indices of the next subset to arrange, or None once the median pair
+    has target_evidence"""
+    rdm, evidence = estimate_rdm(estimate)
+    n_stimuli = len(rdm)
+    upper = np.triu_indices(n_stimuli, 1)
+    if np.median(evidence[upper]) >= target_evidence:
+        return None
+
+    # Anticipate the average distance for pairs not arranged yet
+    rdm = np.where(np.isnan(rdm), np.nanmean(rdm[upper]), rdm)
+    np.fill_diagonal(rdm, 0)
+
+    weakest = np.flatnonzero(evidence[upper] == evidence[upper].min())
+    pair = weakest[rng.randint(len(weakest))]
+    items = [upper[0][pair], upper[1][pair]]
+    while len(items) < size:
+        candidates = np.setdiff1d(np.arange(n_stimuli), items)
+        gains = [subset_gain(rdm, evidence, items + [candidate])
+                 for candidate in candidates]
+        items.append(candidates[int(np.argmax(gains))])
+    return items
+
+
+def next_subset(estimate, size, rng):
+    """The next subset as (stimulus, start position) pairs with the items
+    evenly spaced around the unit circle in random order, or None once the
+    median pair has target_evidence"""
+    items = select_subset(estimate, size, rng)
+    if items is None:
+        return None
+    stimuli = [estimate['stimuli'][i] for i in rng.permutation(items)]
+    angles = 2 * np.pi * np.arange(len(stimuli)) / len(stimuli)
+    return [(stimulus, [np.cos(angle), np.sin(angle)])
+            for stimulus, angle in zip(stimuli, angles)]
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+# Structured event log for the presentation scripts. Events are fixed-schema
+# records (time, event, stimulus, value) appended to an in-memory deque from
+# the render loop, which does no formatting or file I/O; a writer thread
+# drains the deque every flush_interval seconds into a tab-separated file
+# with a header line, read back with load_event_log (or csv, pandas, etc.).
+# Missing stimuli and values are written as 'n/a'.
+
+import csv
+import threading
+from collections import deque
+
+columns = ['time', 'event', 'stimulus', 'value']
+missing = 'n/a'
+
+flush_interval = .5
+
+
+def write_events(event_log):
+    """Writer thread: format and write buffered events until stopped, then
+    write whatever is left"""
+    events, f = event_log['events'], event_log['file']
+    stopping = False
+    while not stopping:
+        stopping = event_log['stop'].wait(flush_interval)
+        lines = []
+        while True:
+            try:
+                time, event, stimulus, value = events.popleft()
+            except IndexError:
+                break
+            lines.append('{0:.4f}\t{1}\t{2}\t{3}\n'.format(time, event, stimulus, value))
+        if lines:
+            f.write(''.join(lines))
+            f.flush()
+
+
+def start_event_log(log_fn, get_time):
+    """Open log_fn and start its writer thread; get_time gives the time of
+    events logged without one, e.g. a PsychoPy clock's getTime"""
+    f = open(log_fn, 'w')
+    f.write('\t'.join(columns) + '\n')
+    event_log = {'file': f, 'get_time': get_time, 'events': deque(),
+                 'stop': threading.Event()}
+    event_log['thread'] = threading.Thread(target=write_events, args=(event_log,))
+    event_log['thread'].daemon = True
+    event_log['thread'].start()
+    return event_log
+
+
+def log_event(event_log, event, stimulus=missing, value=missing, time=None):
+    """Buffer an event, at the current time unless time is given"""
+    if time is None:
+        time = event_log['get_time']()
+    event_log['events'].append((time, event, stimulus, value))
+
+
+def stop_event_log(event_log):
+    """Write the remaining events and close the log"""
+    event_log['stop'].set()
+    event_log['thread'].join()
+    event_log['file'].close()
+
+
+def load_event_log(log_fn):
+    """Events as a list of dicts, with times as floats"""
+    with open(log_fn) as f:
+        events = list(csv.DictReader(f, delimiter='\t'))
+    for event in events:
+        event['time'] = float(event['time'])
+    return events
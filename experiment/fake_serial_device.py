@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+# Fake scanner serial device on a pseudo-terminal, for running
+# actions_presentation.py away from the scanner:
+#   python fake_serial_device.py [TR]
+# prints the device path to pass to actions_presentation.py, then sends a
+# trigger ('5') every TR seconds with random button presses ('1' or '2') in
+# between, until interrupted. To check serial_reader.py's timing instead:
+#   python fake_serial_device.py check [n_bytes]
+
+import os
+import sys
+import time
+import tty
+import numpy as np
+from serial_reader import (start_serial_reader, drain_serial, stop_serial_reader,
+                           default_clock)
+
+tr = 1.0
+
+# Time for the reader to stamp the last bytes of a check
+poll_wait = .2
+
+
+def open_fake_device():
+    """A raw pseudo-terminal; write to the returned file descriptor and read
+    from the device path"""
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    return master, slave, os.ttyname(slave)
+
+
+def send(master, byte):
+    """Write one byte, returning the time just before it was written"""
+    sent = default_clock()
+    os.write(master, byte.encode('ascii'))
+    return sent
+
+
+def run_scanner(master, tr=tr, seed=None):
+    """Trigger every TR, pressing a button about every other TR"""
+    rng = np.random.RandomState(seed)
+    start = default_clock()
+    volume = 0
+    while True:
+        send(master, '5')
+        if rng.rand() < .5:
+            time.sleep(rng.uniform(0, tr))
+            send(master, rng.choice(['1', '2']))
+        volume += 1
+        time.sleep(max(0, start + volume * tr - default_clock()))
+
+
+def check_reader(n_bytes=200):
+    """Latency from writing each byte to the reader stamping it"""
+    master, slave, serial_path = open_fake_device()
+    reader = start_serial_reader(serial_path)
+    sent = []
+    for i in range(n_bytes):
+        sent.append(send(master, '125'[i % 3]))
+        time.sleep(.005)
+    time.sleep(poll_wait)
+    events = drain_serial(reader)
+    stop_serial_reader(reader)
+    os.close(master)
+    os.close(slave)
+    if [byte for stamp, byte in events] != ['125'[i % 3] for i in range(n_bytes)]:
+        raise ValueError("Reader returned {0} of {1} bytes, or out of "
+                         "order".format(len(events), n_bytes))
+    latency = np.array([stamp for stamp, byte in events]) - sent
+    return np.median(latency), latency.max()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'check':
+        n_bytes = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+        median, maximum = check_reader(n_bytes)
+        print("Serial reader latency over {0} bytes: median {1:.3f} ms, "
+              "max {2:.3f} ms".format(n_bytes, median * 1000, maximum * 1000))
+    else:
+        master, slave, serial_path = open_fake_device()
+        print("Fake serial device: {0}".format(serial_path))
+        sys.stdout.flush()
+        try:
+            run_scanner(master, float(sys.argv[1]) if len(sys.argv) > 1 else tr)
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+
+# Frame-accurate scheduling for actions_presentation.py. Trial onsets (in
+# seconds from the first scanner trigger) become target flip indices at the
+# measured refresh rate, and every flip is numbered from its own timestamp
+# on the run clock, so a dropped frame skips an index instead of pushing all
+# later trials back. Each trial then starts on the first flip at or after
+# its target, at most one frame late, and the presentation loop just draws
+# and flips, blocking on the vertical blank rather than polling the clock.
+
+import numpy as np
+
+# Assume this refresh rate if it cannot be measured reliably
+default_rate = 60.
+
+
+def measure_frame_duration(win, default_rate=default_rate):
+    """Seconds per flip from the window's measured refresh rate, and
+    whether that measurement succeeded"""
+    rate = win.getActualFrameRate(nIdentical=60, nMaxFrames=600,
+                                  nWarmUpFrames=20, threshold=1)
+    if rate is None:
+        return 1. / default_rate, False
+    return 1. / rate, True
+
+
+def event_flips(onsets, frame_duration, duration):
+    """First and last (exclusive) flip index of each event"""
+    starts = np.round(np.asarray(onsets) / frame_duration).astype(int)
+    stops = starts + int(round(duration / frame_duration))
+    if np.any(starts[1:] < stops[:-1]):
+        raise ValueError("Events of {0} s overlap at {1} s per "
+                         "flip".format(duration, frame_duration))
+    return starts, stops
+
+
+def flip_index(flip_time, frame_duration):
+    """Index of the flip at flip_time (seconds on the run clock)"""
+    return int(round(flip_time / frame_duration))
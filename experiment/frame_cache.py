@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+# Offline cache of decoded stimulus frames, so runs never decode MP4s. Each
+# clip is decoded once at display width into frame_cache/<clip>.npy, a uint8
+# frames x height x width x 3 (BGR) array that playback memory-maps, and
+# its frame times go into frame_cache/index.npz. Clips whose cache is older
+# than the MP4 are decoded again. Build from the 'actions' directory with:
+#   python frame_cache.py [stimuli] [frame_cache]
+
+import os
+import sys
+from glob import glob
+from os.path import basename, exists, getmtime, join
+import numpy as np
+from movie_prefetch import decode_clip
+
+width = 720
+
+
+def frames_fn(cache_dir, clip_fn):
+    return join(cache_dir, basename(clip_fn) + '.npy')
+
+
+def build_frame_cache(stimulus_dir='stimuli', cache_dir='frame_cache', width=width):
+    """Decode every clip in stimulus_dir that is not cached yet and rewrite
+    the index of frame times"""
+    if not exists(cache_dir):
+        os.makedirs(cache_dir)
+    index = load_frame_index(cache_dir)
+    clips, times = [], []
+    for clip_fn in sorted(glob(join(stimulus_dir, '*.mp4'))):
+        clip = basename(clip_fn)
+        cache_fn = frames_fn(cache_dir, clip_fn)
+        if (clip in index and exists(cache_fn) and
+                getmtime(cache_fn) >= getmtime(clip_fn)):
+            clip_times = index[clip]
+        else:
+            decoded = decode_clip(clip_fn, width)
+            np.save(cache_fn, decoded['frames'])
+            clip_times = decoded['times']
+            print("Cached {0}: {1} frames of {2}".format(
+                clip, len(clip_times), decoded['frames'].shape[1:3]))
+        clips.append(clip)
+        times.append(clip_times)
+    stops = np.cumsum([len(clip_times) for clip_times in times], dtype=int)
+    np.savez(join(cache_dir, 'index.npz'), clips=np.array(clips),
+             start=stops - [len(clip_times) for clip_times in times], stop=stops,
+             times=np.concatenate(times) if times else np.zeros(0))
+    return len(clips)
+
+
+def load_frame_index(cache_dir):
+    """Frame times (in seconds from onset) of each cached clip by name"""
+    index_fn = join(cache_dir, 'index.npz')
+    if not exists(index_fn):
+        return {}
+    with np.load(index_fn) as index:
+        times = index['times']
+        return {str(clip): times[start:stop] for clip, start, stop in
+                zip(index['clips'], index['start'], index['stop'])}
+
+
+def load_cached_clip(index, cache_dir, clip_fn, warm=True):
+    """A clip for movie_prefetch playback with frames memory-mapped from the
+    cache; warm reads one byte per page so frames are resident by onset"""
+    clip = basename(clip_fn)
+    if clip not in index:
+        raise KeyError("{0} is not in the frame cache {1}".format(clip, cache_dir))
+    frames = np.load(frames_fn(cache_dir, clip_fn), mmap_mode='r')
+    if len(frames) != len(index[clip]):
+        raise ValueError("Frame cache for {0} has {1} frames but {2} frame "
+                         "times".format(clip, len(frames), len(index[clip])))
+    if warm:
+        frames.reshape(-1)[::4096].sum()
+    return {'fn': clip_fn, 'times': index[clip], 'frames': frames,
+            'texture': None, 'shown': None}
+
+
+if __name__ == '__main__':
+    stimulus_dir = sys.argv[1] if len(sys.argv) > 1 else 'stimuli'
+    cache_dir = sys.argv[2] if len(sys.argv) > 2 else 'frame_cache'
+    n_clips = build_frame_cache(stimulus_dir, cache_dir)
+    print("Frame cache {0} holds {1} clips".format(cache_dir, n_clips))
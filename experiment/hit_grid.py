@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+# Uniform grid over the arena for finding the thumbnail under the mouse.
+# Each thumbnail (a thumbnail_atlas dict) is listed in the grid cells its
+# bounding box overlaps, with a stacking order matching the draw order, so
+# a lookup only tests the few thumbnails in the cursor's cell and returns
+# the topmost. Moving a thumbnail re-lists it in the cells at its new
+# position; raising it puts it above all others.
+
+import numpy as np
+from thumbnail_atlas import contains
+
+# Cells a bit larger than a thumbnail, so each overlaps at most four
+cell_size = 100
+
+
+def new_grid(cell_size=cell_size):
+    return {'cell_size': cell_size, 'cells': {}, 'items': {},
+            'cell_keys': {}, 'order': {}, 'top': 0}
+
+
+def item_cells(grid, item):
+    """Grid cells overlapped by the item's bounding box"""
+    low = np.floor((item['pos'] - item['size'] / 2.) / grid['cell_size']).astype(int)
+    high = np.floor((item['pos'] + item['size'] / 2.) / grid['cell_size']).astype(int)
+    return [(i, j) for i in range(low[0], high[0] + 1)
+            for j in range(low[1], high[1] + 1)]
+
+
+def add_item(grid, key, item):
+    """List the item on top of the others"""
+    grid['items'][key] = item
+    grid['top'] += 1
+    grid['order'][key] = grid['top']
+    grid['cell_keys'][key] = item_cells(grid, item)
+    for cell in grid['cell_keys'][key]:
+        grid['cells'].setdefault(cell, set()).add(key)
+
+
+def move_item(grid, key):
+    """Re-list the item after its position or size changed"""
+    cells = item_cells(grid, grid['items'][key])
+    if cells == grid['cell_keys'][key]:
+        return
+    for cell in grid['cell_keys'][key]:
+        grid['cells'][cell].discard(key)
+    for cell in cells:
+        grid['cells'].setdefault(cell, set()).add(key)
+    grid['cell_keys'][key] = cells
+
+
+def raise_item(grid, key):
+    grid['top'] += 1
+    grid['order'][key] = grid['top']
+
+
+def item_at(grid, pos):
+    """Key of the topmost item containing pos, or None"""
+    cell = tuple(int(c) for c in np.floor(np.asarray(pos) / grid['cell_size']))
+    hits = [key for key in grid['cells'].get(cell, ())
+            if contains(grid['items'][key], pos)]
+    if not hits:
+        return None
+    return max(hits, key=grid['order'].get)
+
+
+def grid_from_items(items, cell_size=cell_size):
+    """A grid of (key, item) pairs, stacked in the given (draw) order"""
+    grid = new_grid(cell_size)
+    for key, item in items:
+        add_item(grid, key, item)
+    return grid
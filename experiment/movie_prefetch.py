@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+# Background prefetching of movie clips for actions_presentation.py. A
+# reader thread loads the trial order's clips ahead of the presentation loop
+# into a bounded queue of at most n_ahead clips, either decoding them with
+# OpenCV (BGR uint8 frames at display width, as MovieStim2 gets them) or
+# mapping them from the frame cache (frame_cache.py). Playback then only
+# uploads ready frames to an OpenGL texture, choosing the frame for the time
+# since onset from the clip's frame times, so nothing is decoded at onsets.
+
+import threading
+import ctypes
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+import numpy as np
+import cv2
+import pyglet
+GL = pyglet.gl
+
+# 2.5 s clips at 720 pixels wide are about 90 MB decoded, so keep few ahead
+n_ahead = 2
+
+
+def decode_clip(clip_fn, width):
+    """All frames of a clip, resized to width keeping the aspect ratio"""
+    capture = cv2.VideoCapture(clip_fn)
+    if not capture.isOpened():
+        raise IOError("Could not open movie {0}".format(clip_fn))
+    fps = capture.get(cv2.CAP_PROP_FPS)
+    frames, times = [], []
+    while True:
+        time_ms = capture.get(cv2.CAP_PROP_POS_MSEC)
+        ok, frame = capture.read()
+        if not ok:
+            break
+        times.append(time_ms / 1000.)
+        if frame.shape[1] != width:
+            height = int(round(frame.shape[0] * float(width) / frame.shape[1]))
+            frame = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+        frames.append(frame)
+    capture.release()
+    if not frames:
+        raise IOError("Could not decode any frames from {0}".format(clip_fn))
+
+    # Fall back on the nominal frame rate if the timestamps are unusable
+    times = np.array(times)
+    if np.any(np.diff(times) <= 0):
+        times = np.arange(len(frames)) / fps
+    return {'fn': clip_fn, 'times': times - times[0],
+            'frames': np.ascontiguousarray(frames), 'texture': None, 'shown': None}
+
+
+def prefetch_clips(prefetch, clip_fns, load):
+    """Reader thread: load clips in order, waiting while the queue is full"""
+    try:
+        for clip_fn in clip_fns:
+            clip = load(clip_fn)
+            while not prefetch['stop'].is_set():
+                try:
+                    prefetch['queue'].put(clip, timeout=.1)
+                    break
+                except queue.Full:
+                    continue
+            if prefetch['stop'].is_set():
+                return
+    except Exception as error:
+        prefetch['queue'].put(error)
+
+
+def start_prefetch(clip_fns, load, n_ahead=n_ahead):
+    """Start loading clip_fns (in presentation order) on a reader thread;
+    load(clip_fn) returns a clip, e.g. decode_clip at display width"""
+    prefetch = {'queue': queue.Queue(maxsize=n_ahead),
+                'stop': threading.Event()}
+    prefetch['thread'] = threading.Thread(target=prefetch_clips,
+                                          args=(prefetch, clip_fns, load))
+    prefetch['thread'].daemon = True
+    prefetch['thread'].start()
+    return prefetch
+
+
+def next_clip(prefetch, clip_fn, block=True):
+    """The next loaded clip, which must be clip_fn; None if it is not
+    loaded yet and block is False"""
+    try:
+        clip = prefetch['queue'].get(block=block)
+    except queue.Empty:
+        return None
+    if isinstance(clip, Exception):
+        raise clip
+    if clip['fn'] != clip_fn:
+        raise ValueError("Prefetched {0} but expected {1}".format(clip['fn'], clip_fn))
+    return clip
+
+
+def stop_prefetch(prefetch):
+    prefetch['stop'].set()
+    prefetch['thread'].join()
+
+
+def upload_frame(clip, frame_i):
+    """Copy a frame into the clip's texture, allocating it first; frames
+    mapped from the frame cache are uploaded straight from the mapping"""
+    frame = clip['frames'][frame_i]
+    GL.glBindTexture(GL.GL_TEXTURE_2D, clip['texture'])
+    GL.glPixelStorei(GL.GL_UNPACK_ALIGNMENT, 1)
+    if clip['shown'] is None:
+        GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_WRAP_S, GL.GL_CLAMP)
+        GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_WRAP_T, GL.GL_CLAMP)
+        GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MAG_FILTER, GL.GL_LINEAR)
+        GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MIN_FILTER, GL.GL_LINEAR)
+        GL.glTexImage2D(GL.GL_TEXTURE_2D, 0, GL.GL_RGB8, frame.shape[1],
+                        frame.shape[0], 0, GL.GL_BGR, GL.GL_UNSIGNED_BYTE,
+                        frame.ctypes)
+    else:
+        GL.glTexSubImage2D(GL.GL_TEXTURE_2D, 0, 0, 0, frame.shape[1],
+                           frame.shape[0], GL.GL_BGR, GL.GL_UNSIGNED_BYTE,
+                           frame.ctypes)
+    clip['shown'] = frame_i
+
+
+def load_clip_texture(clip):
+    """Create the clip's texture holding its first frame, ahead of onset"""
+    texture = GL.GLuint()
+    GL.glGenTextures(1, ctypes.byref(texture))
+    clip['texture'] = texture
+    upload_frame(clip, 0)
+
+
+def draw_clip(win, clip, t, pos=(0, 0)):
+    """Draw the clip's frame for t seconds after onset (its last frame once
+    it has ended), centered at pos in pixels"""
+    frame_i = max(np.searchsorted(clip['times'], t, side='right') - 1, 0)
+    if frame_i != clip['shown']:
+        upload_frame(clip, frame_i)
+    half_height, half_width = np.array(clip['frames'].shape[1:3]) / 2.
+    x, y = pos
+    vertices = (GL.GLfloat * 20)(
+        0, 0, x - half_width, y + half_height, 0.,  # texture coords, vertex
+        1, 0, x + half_width, y + half_height, 0.,
+        1, 1, x + half_width, y - half_height, 0.,
+        0, 1, x - half_width, y - half_height, 0.)
+    GL.glActiveTexture(GL.GL_TEXTURE0)
+    GL.glColor4f(1, 1, 1, 1)
+    GL.glPushMatrix()
+    win.setScale('pix')
+    GL.glPushAttrib(GL.GL_ENABLE_BIT)
+    GL.glEnable(GL.GL_TEXTURE_2D)
+    GL.glBindTexture(GL.GL_TEXTURE_2D, clip['texture'])
+    GL.glPushClientAttrib(GL.GL_CLIENT_VERTEX_ARRAY_BIT)
+    GL.glInterleavedArrays(GL.GL_T2F_V3F, 0, vertices)
+    GL.glDrawArrays(GL.GL_QUADS, 0, 4)
+    GL.glPopClientAttrib()
+    GL.glPopAttrib()
+    GL.glPopMatrix()
+
+
+def release_clip(clip):
+    """Free the clip's texture and frames"""
+    if clip['texture'] is not None:
+        GL.glDeleteTextures(1, ctypes.byref(clip['texture']))
+    clip['texture'] = None
+    clip['frames'] = None
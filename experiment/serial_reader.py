@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+# Background reader for the scanner's serial device (triggers '5' and button
+# responses '1' and '2'). One thread owns the port for the whole run and
+# reads it a byte at a time, stamping each byte as it arrives, so triggers
+# and responses are timed to well under a millisecond rather than to the
+# flip that happened to poll them. Bytes go onto a deque, whose appends and
+# pops are atomic, and the presentation loop drains it once per flip.
+
+import threading
+import time
+from collections import deque
+import serial
+
+# Let the reader check for stop this often while the port is quiet
+poll_timeout = .1
+
+if hasattr(time, 'monotonic'):
+    default_clock = time.monotonic
+else:
+    default_clock = time.time
+
+
+def read_serial(reader):
+    """Reader thread: stamp and queue bytes until stopped"""
+    port, get_time, events = reader['port'], reader['get_time'], reader['events']
+    while not reader['stop'].is_set():
+        byte = port.read(1)
+        if byte:
+            events.append((get_time(), byte.decode('ascii', 'replace')))
+
+
+def start_serial_reader(serial_path, baudrate=115200, get_time=default_clock):
+    """Open the serial device and start reading it on a background thread;
+    get_time stamps each byte, e.g. psychopy.core.getTime"""
+    port = serial.Serial(serial_path, baudrate, timeout=poll_timeout)
+    port.flushInput()
+    reader = {'port': port, 'get_time': get_time, 'events': deque(),
+              'stop': threading.Event()}
+    reader['thread'] = threading.Thread(target=read_serial, args=(reader,))
+    reader['thread'].daemon = True
+    reader['thread'].start()
+    return reader
+
+
+def drain_serial(reader):
+    """All (time, byte) pairs received since the last drain"""
+    events = []
+    while True:
+        try:
+            events.append(reader['events'].popleft())
+        except IndexError:
+            return events
+
+
+def stop_serial_reader(reader):
+    reader['stop'].set()
+    reader['thread'].join()
+    reader['port'].close()
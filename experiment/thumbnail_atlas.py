@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+
+# Texture atlas for the arrangement thumbnails. Every image used in a
+# session is loaded once at startup, resized to one cell (the zoomed size)
+# and packed into a single RGBA texture, with each stimulus's texture
+# coordinates kept alongside. Thumbnails are then plain dicts of stimulus,
+# position and size in pixels, drawn from the atlas in one batch per frame,
+# so subsets only set positions and zooming just draws a bigger quad.
+
+import ctypes
+import numpy as np
+from PIL import Image
+import pyglet
+GL = pyglet.gl
+
+# Cells hold images at the zoomed size, so zooming never upscales
+cell_size = (256, 144)
+
+
+def load_atlas(image_fns, cell_size=cell_size):
+    """Pack images, given as a dict of stimulus to file name, into one
+    texture; returns the atlas with (u0, v0, u1, v1) per stimulus"""
+    stimuli = sorted(image_fns)
+    n_columns = int(np.ceil(np.sqrt(len(stimuli))))
+    n_rows = int(np.ceil(len(stimuli) / float(n_columns)))
+    width, height = cell_size
+    pixels = np.zeros((n_rows * height, n_columns * width, 4), dtype=np.uint8)
+    coords = {}
+    for i, stimulus in enumerate(stimuli):
+        row, column = divmod(i, n_columns)
+        image = Image.open(image_fns[stimulus]).convert('RGBA')
+        image = image.resize(cell_size, Image.BILINEAR)
+        pixels[row * height:(row + 1) * height,
+               column * width:(column + 1) * width] = np.asarray(image)
+        coords[stimulus] = (column / float(n_columns), row / float(n_rows),
+                            (column + 1) / float(n_columns), (row + 1) / float(n_rows))
+
+    texture = GL.GLuint()
+    GL.glGenTextures(1, ctypes.byref(texture))
+    GL.glBindTexture(GL.GL_TEXTURE_2D, texture)
+    GL.glPixelStorei(GL.GL_UNPACK_ALIGNMENT, 1)
+    GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_WRAP_S, GL.GL_CLAMP)
+    GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_WRAP_T, GL.GL_CLAMP)
+    GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MAG_FILTER, GL.GL_LINEAR)
+    GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MIN_FILTER, GL.GL_LINEAR)
+    GL.glTexImage2D(GL.GL_TEXTURE_2D, 0, GL.GL_RGBA8, pixels.shape[1], pixels.shape[0],
+                    0, GL.GL_RGBA, GL.GL_UNSIGNED_BYTE, pixels.ctypes)
+    return {'texture': texture, 'coords': coords}
+
+
+def thumbnail(stimulus, pos, size):
+    """A thumbnail of stimulus centered at pos, both in pixels"""
+    return {'stimulus': stimulus, 'pos': np.array(pos, dtype=float),
+            'size': np.array(size, dtype=float)}
+
+
+def contains(item, pos):
+    """Whether pos (in pixels) falls on the thumbnail"""
+    return bool(np.all(np.abs(np.asarray(pos) - item['pos']) <= item['size'] / 2.))
+
+
+def draw_thumbnails(win, atlas, items):
+    """Draw thumbnails in order (later ones on top) with one draw call"""
+    if not items:
+        return
+    vertices = np.zeros((len(items), 4, 5), dtype=np.float32)
+    for i, item in enumerate(items):
+        u0, v0, u1, v1 = atlas['coords'][item['stimulus']]
+        x, y = item['pos']
+        half_width, half_height = item['size'] / 2.
+        vertices[i] = [[u0, v0, x - half_width, y + half_height, 0.],  # texture coords, vertex
+                       [u1, v0, x + half_width, y + half_height, 0.],
+                       [u1, v1, x + half_width, y - half_height, 0.],
+                       [u0, v1, x - half_width, y - half_height, 0.]]
+    GL.glActiveTexture(GL.GL_TEXTURE0)
+    GL.glColor4f(1, 1, 1, 1)
+    GL.glPushMatrix()
+    win.setScale('pix')
+    GL.glPushAttrib(GL.GL_ENABLE_BIT)
+    GL.glEnable(GL.GL_TEXTURE_2D)
+    GL.glBindTexture(GL.GL_TEXTURE_2D, atlas['texture'])
+    GL.glPushClientAttrib(GL.GL_CLIENT_VERTEX_ARRAY_BIT)
+    GL.glInterleavedArrays(GL.GL_T2F_V3F, 0, vertices.ctypes)
+    GL.glDrawArrays(GL.GL_QUADS, 0, 4 * len(items))
+    GL.glPopClientAttrib()
+    GL.glPopAttrib()
+    GL.glPopMatrix()
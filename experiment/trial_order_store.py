@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+# Single container for every participant's trial orders, written by
+# trial_order.py and read here by actions_presentation.py. Trials are
+# records (onset, category, stimulus, probe) in one structured array, with
+# stimulus file names and probe verbs as indices into lookup tables stored
+# alongside; the first two stimuli are fixation and question, and trials
+# without a question have probe (-1, -1). An index of participant, session
+# and run gives each run's slice of the trials.
+
+import os
+import numpy as np
+
+trial_dtype = np.dtype([('onset', np.float64),
+                        ('category', np.int8),
+                        ('stimulus', np.int16),
+                        ('probe', np.int16, (2,))])
+
+fixation = 0
+question = 1
+special_stimuli = ['fixation', 'question']
+
+index_columns = ['participant', 'session', 'run']
+
+
+def new_trial_orders(stimuli, verbs):
+    """Empty container for trial orders using these lookup tables"""
+    trial_orders = {column: [] for column in index_columns}
+    trial_orders['runs'] = []
+    trial_orders['stimuli'] = np.asarray(stimuli)
+    trial_orders['verbs'] = np.asarray(verbs)
+    return trial_orders
+
+
+def load_trial_orders(store_fn, stimuli=None, verbs=None):
+    """Load every stored run as a list of record arrays, or start a new
+    container with the given lookup tables if there is none yet"""
+    if not os.path.exists(store_fn):
+        return new_trial_orders(stimuli, verbs)
+    with np.load(store_fn) as saved:
+        trial_orders = new_trial_orders(saved['stimuli'], saved['verbs'])
+        for column in index_columns:
+            trial_orders[column] = list(saved[column])
+        trials = saved['trials']
+        trial_orders['runs'] = [trials[start:stop] for start, stop in
+                                zip(saved['start'], saved['stop'])]
+    return trial_orders
+
+
+def save_trial_orders(trial_orders, store_fn):
+    """Write the trials, index and lookup tables to one NPZ file, replacing
+    it atomically"""
+    lengths = [len(run) for run in trial_orders['runs']]
+    stop = np.cumsum(lengths, dtype=int)
+    if trial_orders['runs']:
+        trials = np.concatenate(trial_orders['runs'])
+    else:
+        trials = np.zeros(0, dtype=trial_dtype)
+    tmp_fn = '{0}.{1}'.format(store_fn, os.getpid())
+    with open(tmp_fn, 'wb') as f:
+        np.savez(f, trials=trials, start=stop - lengths, stop=stop,
+                 stimuli=trial_orders['stimuli'], verbs=trial_orders['verbs'],
+                 **{column: np.array(trial_orders[column], dtype=int)
+                    for column in index_columns})
+    os.rename(tmp_fn, store_fn)
+
+
+def add_trial_orders(trial_orders, participant, sessions, stimuli, verbs):
+    """Store a participant's sessions (each a runs x trials record array
+    indexing stimuli and verbs), replacing any earlier trial orders for them"""
+    if (not np.array_equal(trial_orders['stimuli'], stimuli) or
+            not np.array_equal(trial_orders['verbs'], verbs)):
+        raise ValueError("Stimulus or verb tables differ from those of the "
+                         "stored trial orders")
+    keep = [i for i, p in enumerate(trial_orders['participant']) if p != participant]
+    for column in index_columns + ['runs']:
+        trial_orders[column] = [trial_orders[column][i] for i in keep]
+    for session_i, runs in enumerate(sessions):
+        for run_i, run in enumerate(runs):
+            trial_orders['participant'].append(participant)
+            trial_orders['session'].append(session_i + 1)
+            trial_orders['run'].append(run_i + 1)
+            trial_orders['runs'].append(np.asarray(run, dtype=trial_dtype))
+
+
+def load_run(store_fn, participant, session, run):
+    """A run's trial records with the stimulus and verb lookup tables"""
+    with np.load(store_fn) as saved:
+        rows = np.flatnonzero((saved['participant'] == participant) &
+                              (saved['session'] == session) &
+                              (saved['run'] == run))
+        if len(rows) == 0:
+            raise KeyError("No trial order stored for participant {0} "
+                           "session {1} run {2}".format(participant, session, run))
+        start, stop = saved['start'][rows[0]], saved['stop'][rows[0]]
+        return saved['trials'][start:stop], saved['stimuli'], saved['verbs']
+
+
+def trial_list(records, stimuli, verbs):
+    """Records as the former per-run list of [onset, category, stimulus]
+    trials, with [verb, verb] appended to questions"""
+    trials = []
+    for record in records:
+        trial = [float(record['onset']), int(record['category']),
+                 str(stimuli[record['stimulus']])]
+        if record['probe'][0] >= 0:
+            trial.append([str(verbs[i]) for i in record['probe']])
+        trials.append(trial)
+    return trials
+
+
+def load_trial_order(store_fn, participant, session, run):
+    """A run's trials, as in the former trial_order_p{p}_s{s}_r{r}.hdf5"""
+    return trial_list(*load_run(store_fn, participant, session, run))
@@ -4,10 +4,16 @@
 import sys
 import json
 from collections import OrderedDict
-from os.path import join
+from os.path import abspath, dirname, join
 import time
+import numpy as np
 from psychopy import core, event, logging, visual
 from mvpa2.base.hdf5 import h5load, h5save
+sys.path.append(join(dirname(abspath(__file__)), '..', 'experiment'))
+from event_log import start_event_log, log_event, stop_event_log
+from thumbnail_atlas import load_atlas, cell_size, thumbnail, contains, draw_thumbnails
+from hit_grid import grid_from_items, move_item, raise_item, item_at
+from adaptive_subsets import new_estimate, add_arrangement, next_subset
 
 participant = int(sys.argv[1])
 session = int(sys.argv[2])
@@ -21,14 +27,20 @@ assert task in ['person', 'object', 'scene']
 subsets = h5load('arrangements/starting_frame_arrangements_n{0}_r{1}_p{2}_s{3}.hdf5'.format(
                     subset_size, n_subsets, participant, session))
 
+# The number of subsets arranged varies with the adaptive selection, so it
+# is saved with the arrangements (keyed by subset) rather than in the name
+results_fn = 'arrangements/final_arrangements_n{0}_p{1}_s{2}'.format(
+                subset_size, participant, session)
+
 clock = core.Clock()
 logging.setDefaultClock(clock)
 log = logging.LogFile(f=join('logs', 'arrangement_log_p{0}_s{1}.txt'.format(
-                participant, session)), level=logging.DATA,
+                participant, session)), level=logging.WARNING,
                 filemode='w')
-logging.data("Arrangements for participant {0}, session {1}, "
-             "{2} task, with {3} subsets of {4} items".format(
-                participant, session, task, n_subsets, subset_size))
+events = start_event_log(join('logs', 'arrangement_events_p{0}_s{1}.tsv'.format(
+                participant, session)), clock.getTime)
+log_event(events, 'task', value=task)
+log_event(events, 'max_subsets', value='{0}x{1}'.format(n_subsets + 1, subset_size))
 win = visual.Window(size=(1920, 1200), color=(0, 0, 0), fullscr=True,
                     screen=1, units='pix')
 
@@ -102,12 +114,15 @@ quit_prompt = visual.TextStim(win, text=("Are you sure you want to quit? "
                                          "(press 'y' or 'n')"),
                               wrapWidth=950, name="Quit?")
 quit_prompt.height = 36
-loading = visual.TextStim(win, text=("Loading..."),
-                          wrapWidth=950, name="Loading")
-loading.height = 36
 
 mouse = event.Mouse()
 
+# Load every image in the session into one texture while the instructions
+# are shown, so subsets start without loading
+atlas = load_atlas({stimulus: join('stimuli', 'frames',
+                                   stimulus + '_frame001_{0}.png'.format(task))
+                    for subset in subsets for stimulus, start_position in subset})
+
 start = False
 while not start:
     instructions.draw()
@@ -116,6 +131,8 @@ while not start:
     if 'space' in keys or 'return' in keys:
         start = True
     if 'q' in keys or 'escape' in keys:
+        log_event(events, 'quit')
+        stop_event_log(events)
         win.close()
         core.quit()
 
@@ -140,106 +157,94 @@ elif task == 'scene':
                                pos=(-920, 560), alignHoriz='left',
                                alignVert='top')
 
-logging.data("Starting experiment!")
-results = {}
-for subset_i, subset in enumerate(subsets):
-    loading.draw()
-    reminder.draw()
-    arena.draw()
-    win.flip()
+highlight = visual.Rect(win, fillColor='white', units='pix')
+
+# The first trial arranges all items from the starting arrangements; after
+# that, each subset of subset_size items is chosen from the arrangements so
+# far to lift the pairs with the least evidence, for up to n_subsets trials
+# or until the estimate is reliable enough
+estimate = new_estimate([stimulus for stimulus, start_position in subsets[0]])
+rng = np.random.RandomState(participant * 1000 + session)
+subset_i, subset = 0, subsets[0]
 
+log_event(events, 'start')
+results = {}
+while subset is not None:
     starting_positions = {stimulus: [s * (radius + 60) for s in start_position]
                           for stimulus, start_position in subset}
     if subset_i == 0:
-        frames = OrderedDict({stimulus: visual.ImageStim(win, image=join('stimuli', 'frames',
-                                                  stimulus + '_frame001_{0}.png'.format(task)),
-                                   size=(60, 60), units='pix',
-                                   pos=[s * (radius + 60) for s in start_position],
-                                   name=stimulus)
+        frames = OrderedDict({stimulus: thumbnail(stimulus, [s * (radius + 60) for s in start_position],
+                                                  (60, 60))
                   for stimulus, start_position in subset})
     elif subset_i > 0:
-        frames = OrderedDict({stimulus: visual.ImageStim(win, image=join('stimuli', 'frames',
-                                                  stimulus + '_frame001_{0}.png'.format(task)),
-                                   size=(72, 72), units='pix',
-                                   pos=[s * (radius + 60) for s in start_position],
-                                   name=stimulus)
+        frames = OrderedDict({stimulus: thumbnail(stimulus, [s * (radius + 60) for s in start_position],
+                                                  (72, 72))
                   for stimulus, start_position in subset})
 
-    for frame in frames.values():
-        frame.draw()
-    win.flip()
-    logging.data("Finished drawing images, starting trial {0}!".format(subset_i))
+    log_event(events, 'trial_start', value=subset_i)
 
+    # All images are drawn from the atlas in one batch, in order, so a moved
+    # image is drawn last; the grid finds the topmost image under the mouse
+    grid = grid_from_items(frames.items())
     finished = False
     while not finished:
         arena.draw()
         reminder.draw()
-        for frame in frames.values():
-            frame.draw()
+        draw_thumbnails(win, atlas, frames.values())
         win.flip()
 
-        was_dragged = None
-        for stimulus, frame in frames.items()[::-1]:
-            while mouse.isPressedIn(frame, buttons=[0]) or (was_dragged and mouse.getPressed()[0] == 1):
-                if not was_dragged:
-                    frames[stimulus] = frames.pop(stimulus)
-                    was_dragged = frame
+        buttons = mouse.getPressed()
+        stimulus = item_at(grid, mouse.getPos()) if any(buttons) else None
+        if stimulus is not None:
+            frame = frames[stimulus]
+
+        if stimulus is not None and buttons[0] == 1:
+            frames[stimulus] = frames.pop(stimulus)
+            raise_item(grid, stimulus)
+            while mouse.getPressed()[0] == 1:
                 position = mouse.getPos()
-                frame.pos = position
+                frame['pos'] = position
                 arena.draw()
                 reminder.draw()
-                for other_stimulus, other_frame in frames.items():
-                    if other_stimulus != stimulus:
-                        other_frame.draw()
-                frame.draw()
+                draw_thumbnails(win, atlas, frames.values())
                 win.flip()
-            if was_dragged:
-                break
-        
-        for stimulus, frame in frames.items()[::-1]:
-            if mouse.isPressedIn(frame, buttons=[2]):
-                second_click = False
-                while not second_click:
-                    mouse.clickReset()
-                    buttons = mouse.getPressed()
-                    if buttons[0] == 1:
-                        position = mouse.getPos()
-                        second_click = True
-                    else:
-                        highlight = visual.Rect(win, fillColor='white',
-                                        width=frame.size[0] + 6,
-                                        height=frame.size[1] + 6, 
-                                        pos=frame.pos)
-                        arena.draw()
-                        reminder.draw()
-                        for other_stimulus, other_frame in frames.items():
-                            if other_stimulus != stimulus:
-                                other_frame.draw()
-                        highlight.draw()
-                        frame.draw()
-                        win.flip()
-                frame.pos = position
-                arena.draw()
-                reminder.draw()
-                for other_stimulus, other_frame in frames.items():
-                    if other_stimulus != stimulus:
-                        other_frame.draw()
-                frame.draw()
-                win.flip()
-       
-        for stimulus, frame in frames.items()[::-1]: 
-            if mouse.isPressedIn(frame, buttons=[1]):
-                zoomed = visual.ImageStim(win, image=join('stimuli', 'frames',
-                                                  stimulus + '_frame001_{0}.png'.format(task)),
-                                   size=(256, 144), units='pix', pos=frame.pos,
-                                   name='Zoomed image')
-                while mouse.isPressedIn(zoomed, buttons=[1]):
+            move_item(grid, stimulus)
+
+        elif stimulus is not None and buttons[2] == 1:
+            others = [other_frame for other_stimulus, other_frame in frames.items()
+                      if other_stimulus != stimulus]
+            highlight.width = frame['size'][0] + 6
+            highlight.height = frame['size'][1] + 6
+            highlight.pos = frame['pos']
+            second_click = False
+            while not second_click:
+                mouse.clickReset()
+                buttons = mouse.getPressed()
+                if buttons[0] == 1:
+                    position = mouse.getPos()
+                    second_click = True
+                else:
                     arena.draw()
                     reminder.draw()
-                    for frame in frames.values():
-                        frame.draw()
-                    zoomed.draw()
+                    draw_thumbnails(win, atlas, others)
+                    highlight.draw()
+                    draw_thumbnails(win, atlas, [frame])
                     win.flip()
+            frame['pos'] = position
+            move_item(grid, stimulus)
+            arena.draw()
+            reminder.draw()
+            draw_thumbnails(win, atlas, others + [frame])
+            win.flip()
+
+        elif stimulus is not None and buttons[1] == 1:
+            zoomed = thumbnail(stimulus, frame['pos'], cell_size)
+            log_event(events, 'zoom', stimulus=stimulus)
+            while mouse.getPressed()[1] and contains(zoomed, mouse.getPos()):
+                arena.draw()
+                reminder.draw()
+                draw_thumbnails(win, atlas, frames.values() + [zoomed])
+                win.flip()
 
         keys = event.getKeys()
         if 'space' in keys or 'return' in keys:
@@ -255,8 +260,8 @@ for subset_i, subset in enumerate(subsets):
                     for name, stimulus in frames.items():
                         results[subset_i][name] = {}
                         results[subset_i][name]['start'] = starting_positions[name]
-                        results[subset_i][name]['finish'] = stimulus.pos.tolist()
-                    logging.data("Done trial {0}, recorded results!".format(subset_i))
+                        results[subset_i][name]['finish'] = stimulus['pos'].tolist()
+                    log_event(events, 'trial_done', value=subset_i)
                     responded = True
                     finished = True
                     
@@ -269,25 +274,32 @@ for subset_i, subset in enumerate(subsets):
                 if 'n' in keys:
                     responded = True
                 if 'y' in keys:
-                    fn = 'arrangements/final_arrangements_n{0}_r{1}_p{2}_s{3}'.format(
-                                subset_size, n_subsets, participant, session)
-                    h5save('{0}.hdf5'.format(fn), results)
-                    with open('{0}.json'.format(fn), 'w') as f:
-                        json.dump(results, f, indent=2)
+                    saved = {'n_subsets': len(results), 'arrangements': results}
+                    h5save('{0}.hdf5'.format(results_fn), saved)
+                    with open('{0}.json'.format(results_fn), 'w') as f:
+                        json.dump(saved, f, indent=2)
+                    log_event(events, 'quit')
+                    stop_event_log(events)
                     win.close()
                     core.quit()
 
-logging.data("Completed experiment, saving results!")
+    add_arrangement(estimate, {name: frame['pos'] for name, frame in frames.items()})
+    subset_i += 1
+    if subset_i <= n_subsets:
+        subset = next_subset(estimate, subset_size, rng)
+    else:
+        subset = None
+
+log_event(events, 'complete', value=subset_i)
 complete = visual.TextStim(win, text=("Experiment complete. Thanks!"),
                           wrapWidth=950, name="Complete")
 complete.height = 36
 complete.draw()
 win.flip()
-fn = 'arrangements/final_arrangements_n{0}_r{1}_p{2}_s{3}'.format(
-            subset_size, n_subsets, participant, session)
-h5save('{0}.hdf5'.format(fn), results)
-with open('{0}.json'.format(fn), 'w') as f:
-    json.dump(results, f, indent=2)
+saved = {'n_subsets': len(results), 'arrangements': results}
+h5save('{0}.hdf5'.format(results_fn), saved)
+with open('{0}.json'.format(results_fn), 'w') as f:
+    json.dump(saved, f, indent=2)
 
 end_experiment = False
 while not end_experiment:
@@ -295,5 +307,7 @@ while not end_experiment:
     win.flip()
     keys = event.getKeys()
     if 'q' in keys or 'escape' in keys:
+        log_event(events, 'quit')
+        stop_event_log(events)
         win.close()
         core.quit()
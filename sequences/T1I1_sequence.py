@@ -4,15 +4,24 @@
 
 import numpy as np
 import itertools
+from os.path import abspath, dirname, exists, join
 from copy import deepcopy
+from multiprocessing import Pool, cpu_count
 from scipy.spatial.distance import squareform
-from evalseqshard import EvaluateSeqshard, vec2sim
+from evalseqshard import EvaluateSeqshard, MergeSeqshards, eucsum, vec2sim
+from design_store import new_store, append_design, save_store, participant_runs
 import matplotlib.pyplot as plt
-from mvpa2.base.hdf5 import h5save
+from mvpa2.base.hdf5 import h5load, h5save
+
+# Root of this repository, where stimuli.csv and the model RDMs live
+scripts_dir = abspath(join(dirname(abspath(__file__)), '..'))
 
 # Participant number for random seed
 participant = 1
 
+# Every participant's session sequences, runs, efficiencies and seeds
+store_fn = 'sequence_designs.npz'
+
 # Create dictionary of parameters for EvaluateSeqshard function
 parameters = {'N': 20,
               'perms': 1000,
@@ -20,7 +29,17 @@ parameters = {'N': 20,
               'BlankLength': 1,
               'doubleblanks': False,
               'target': 19,
-              'numSeqs': 1000}
+              'numSeqs': 1000,
+              'batchsize': 100,
+              'streaming': True,
+              'method': 'rfft',
+              'optimizer': 'random'}
+
+# Each participant's permutations are split into this many chunks, each
+# searched with its own random stream spawned from the participant seed, so
+# results depend on the chunking but not on the number of worker processes
+n_chunks = 32
+n_processes = cpu_count()
 
 # Simple similarity matrix separating the 20 categories
 category_rdm = np.array([[0., 1., 1., 1., 1., 1., 1., 1., 1., 1., 1., 1., 1., 1., 1., 1., 1., 1.],
@@ -43,121 +62,184 @@ category_rdm = np.array([[0., 1., 1., 1., 1., 1., 1., 1., 1., 1., 1., 1., 1., 1.
                          [1., 1., 1., 1., 1., 1., 1., 1., 1., 1., 1., 1., 1., 1., 1., 1., 1., 0.]])
 
 
+# Model RDMs over the 90 stimuli (condensed, stimuli sorted by filename) to
+# optimize the design for jointly with the category RDM
+model_rdm_fns = {'motion_energy': join(scripts_dir, 'RDMs', 'motion_energy_target_RDM.hdf5'),
+                 'gaze': join(scripts_dir, 'gaze', 'gaze_target_RDM.hdf5'),
+                 'word2vec': join(scripts_dir, 'RDMs', 'word2vec_target_RDM.hdf5'),
+                 'arrangement': join(scripts_dir, 'RDMs', 'arrangement_target_RDM.hdf5')}
+
+# Models the design is scored against; all must be built before searching
+model_rdm_names = sorted(model_rdm_fns)
+
+
+def category_rdm_from_stimuli(stimulus_rdm, stimulus_categories):
+    """Average a condensed stimulus RDM over the stimulus pairs of each category pair"""
+    stimulus_rdm = squareform(stimulus_rdm)
+    categories = np.unique(stimulus_categories)
+    rdm = np.zeros((len(categories), len(categories)))
+    for i, j in itertools.permutations(range(len(categories)), 2):
+        rdm[i, j] = stimulus_rdm[np.ix_(stimulus_categories == categories[i],
+                                        stimulus_categories == categories[j])].mean()
+    return rdm
+
+
+def load_model_rdms(model_names=model_rdm_names):
+    """Stack the category RDM and the named model RDMs along a third axis;
+    raises IOError if any of their files are missing"""
+    names, rdms = ['category'], [category_rdm]
+    if not model_names:
+        return names, np.dstack(rdms)
+    stimuli_fn = join(scripts_dir, 'stimuli.csv')
+    missing = [fn for fn in [stimuli_fn] + [model_rdm_fns[name] for name in model_names]
+               if not exists(fn)]
+    if missing:
+        raise IOError("Missing files for model RDMs {0} (build them or remove the "
+                      "models from model_rdm_names): {1}".format(
+                          ', '.join(model_names), ', '.join(missing)))
+    with open(stimuli_fn) as f:
+        stimuli = sorted([(line.strip().split(',')[2], int(line.split(',')[1]))
+                          for line in f.readlines()])
+    stimulus_categories = np.array([category for stimulus, category in stimuli])
+    for name in model_names:
+        names.append(name)
+        rdms.append(category_rdm_from_stimuli(h5load(model_rdm_fns[name]),
+                                              stimulus_categories))
+    return names, np.dstack(rdms)
+
+
 # Plot RDM
 #get_ipython().magic(u'matplotlib inline')
 #plt.matshow(category_rdm); plt.show()
 
-# Reformat single RDM for EvaluateSeqshard function
-rdms = category_rdm[:, :, None]
-
-# Create sequences for 30 participant indices
-for participant in range(1, 31):
-
-    # Set seed to get same sequence across runs
-    np.random.seed(participant)
-    results = EvaluateSeqshard(parameters, rdms)
-
-    # View condition labels
-    # 0 = fixation trial, 21 = catch trial
-    print(np.unique(results['BestSeqs'][:, 0]))
-
-    # Sort according to the efficiency
-    sort_idx = np.argsort(results['bestEs'][0, :])[::-1]
-
-    # Sort efficiencies
-    efficiencies = results['bestEs'][0, sort_idx].T
-
-    # Sort sequences
-    sequences = results['BestSeqs'][:, sort_idx].T
-    assert len(sequences[0]) == int(parameters['N'])**2 + 1
-
-    # Each sequence is $20^2 + 1 = 400$ trials long. We use two sequences ending with the same trial number per participant.
-
-    # Save efficiencies and sequences
-    #np.savetxt('sequences_{0}.txt'.format(participant),
-    #           sequences, fmt='%d', delimiter=',')
-    #np.savetxt('efficiencies_{0}.txt'.format(participant),
-    #           efficiencies)
-
-    # Find next best sequence with same starting trial
-    # And make sure sequence doesn't have 19, i.e., the question, in trial 1
-    for i, sequence in enumerate(sequences):
+# Stack RDMs along a third axis for EvaluateSeqshard function, which scores
+# every sequence against all of them and ranks by their euclidean sum
+model_names, rdms = load_model_rdms()
+
+
+def search_chunk(task):
+    """Run EvaluateSeqshard on one chunk of a participant's permutations"""
+    seed, perms = task
+    chunk_parameters = dict(parameters, perms=perms,
+                            numSeqs=min(perms, parameters['numSeqs']))
+    return EvaluateSeqshard(chunk_parameters, rdms,
+                            rng=np.random.default_rng(seed))
+
+
+def search_participants(participants, n_chunks=n_chunks,
+                        n_processes=n_processes):
+    """Fan permutation chunks for all participants out to a process pool"""
+    chunk_perms = [len(chunk) for chunk in
+                   np.array_split(np.arange(parameters['perms']), n_chunks)
+                   if len(chunk) > 0]
+    tasks = []
+    for participant in participants:
+        seeds = np.random.SeedSequence(participant).spawn(len(chunk_perms))
+        tasks.extend(zip(seeds, chunk_perms))
+
+    # Merge each participant's chunks as they arrive to bound memory
+    pool = Pool(n_processes)
+    chunk_results = pool.imap(search_chunk, tasks)
+    cohort_results = {}
+    for participant in participants:
+        cohort_results[participant] = MergeSeqshards(
+            [next(chunk_results) for chunk in chunk_perms],
+            parameters['numSeqs'])
+    pool.close()
+    pool.join()
+    return cohort_results
+
+
+if __name__ == '__main__':
+
+    # Create sequences for 30 participant indices
+    cohort_results = search_participants(range(1, 31))
+    store = new_store()
+    for participant in range(1, 31):
+
+        # Seeds are derived from the participant number to get same sequence across runs
+        results = cohort_results[participant]
+
+        # View condition labels
+        # 0 = fixation trial, 21 = catch trial
+        print(np.unique(results['BestSeqs'][:, 0]))
+
+        # Sort according to the efficiency summed over models
+        sort_idx = np.argsort(eucsum(results['bestEs']))[::-1]
+
+        # Sort efficiencies (sequences x models)
+        efficiencies = results['bestEs'][:, sort_idx].T
+
+        # Sort sequences
+        sequences = results['BestSeqs'][:, sort_idx].T
+        assert len(sequences[0]) == int(parameters['N'])**2 + 1
+
+        # Each sequence is $20^2 + 1 = 400$ trials long. We use two sequences ending with the same trial number per participant.
+
+        # Save efficiencies and sequences
+        #np.savetxt('sequences_{0}.txt'.format(participant),
+        #           sequences, fmt='%d', delimiter=',')
+        #np.savetxt('efficiencies_{0}.txt'.format(participant),
+        #           efficiencies)
+
+        # Find next best sequence with same starting trial
+        # And make sure sequence doesn't have 19, i.e., the question, in trial 1
+        for i, sequence in enumerate(sequences):
     
-        first_trials = [run[-3] for run in np.split(sequence[1:], 4)]
-        print(first_trials)
-        if 19. in first_trials:
-            print("First trial was question for sequence {0}, "
-                      "skipping to next".format(i))
-            continue
-        else:
-            break
-    sequence_one = sequence
-    sequence_one_id = deepcopy(i)
-    print("Found good sequence (number {0})".format(i))
+            first_trials = [run[-3] for run in np.split(sequence[1:], 4)]
+            print(first_trials)
+            if 19. in first_trials:
+                print("First trial was question for sequence {0}, "
+                          "skipping to next".format(i))
+                continue
+            else:
+                break
+        sequence_one = sequence
+        sequence_one_id = deepcopy(i)
+        print("Found good sequence (number {0})".format(i))
  
-    matching_seq_ids = list(np.where(sequences[:, 0] == sequence[0])[0][1:])
-    matching_sequences = sequences[matching_seq_ids]
-    matching_seq_n = len(matching_seq_ids)
+        matching_seq_ids = list(np.where(sequences[:, 0] == sequence[0])[0][1:])
+        matching_sequences = sequences[matching_seq_ids]
+        matching_seq_n = len(matching_seq_ids)
 
-    for i, sequence in enumerate(matching_sequences):
+        for i, sequence in enumerate(matching_sequences):
         
-        first_trials = [run[-3] for run in np.split(sequence[1:], 4)]
-        print(first_trials)
-        if 21. in first_trials:
-            print("First trial was question for matching sequence {0}, "
-                      "skipping to next".format(matching_seq_ids[i]))
-            if i + 1 == matching_seq_n:
-                raise Exception, "Ran out of matching sequences for participant {0}!!!".format(participant)
+            first_trials = [run[-3] for run in np.split(sequence[1:], 4)]
+            print(first_trials)
+            if 21. in first_trials:
+                print("First trial was question for matching sequence {0}, "
+                          "skipping to next".format(matching_seq_ids[i]))
+                if i + 1 == matching_seq_n:
+                    raise Exception("Ran out of matching sequences for participant {0}!!!".format(participant))
+                else:
+                    continue
             else:
-                continue
-        else:
-            break
-    sequence_two = sequence
-    sequence_two_id = matching_seq_ids[i]
-    print("Found good matching sequence (number {0})".format(matching_seq_ids[i]))
-
-    assert sequence_one[0] == sequence_two[0]
-    assert not np.array_equal(sequence_one, sequence_two)
-
-    # Print sequences
-    print("Session one sequence (efficiency = {0}):\n{1}".format(
-            efficiencies[sequence_one_id], sequence_one))
-    print("Session two sequence (efficiency = {0}):\n{1}".format(
-            efficiencies[sequence_two_id], sequence_two))
-
-    # Save optimized sequences for sessions 1 and 2
-    np.savetxt('sequence_subject{0}_session1.txt'.format(participant),
-               sequence_one, fmt='%d', delimiter=',')
-    np.savetxt('sequence_subject{0}_session2.txt'.format(participant),
-               sequence_two, fmt='%d', delimiter=',')
-
-# Check that all participants have different sequences
-all_seqs = []
-for participant in range(1, 31):
-    for session in [1, 2]:
-        with open('sequence_subject{0}_session{1}.txt'.format(participant, session)) as f:
-            # Drop first item, we'll append it back on
-            all_seqs.append([int(line) for line in f.readlines()][1:])
-for a, b in itertools.combinations(all_seqs, 2):                                                                                              
-        assert not np.array_equal(a, b)
-
-# Compile sequence
-for participant in range(1, 31):
-    session_seqs = []
-    for session in [1, 2]:
-        with open('sequence_subject{0}_session{1}.txt'.format(participant, session)) as f:
-            # Drop first item, we'll append it back on
-            seq = [int(line) for line in f.readlines()][1:]
-
-        run_seqs = np.split(np.array(seq), 4)
-
-        extended = []
-        extended.append(np.append(run_seqs[-1][-3:], run_seqs[0]))
-        for i in range(1, len(run_seqs)):
-            extended.append(np.append(run_seqs[i - 1][-3:], run_seqs[i]))
-
-        session_seqs.append(np.array(extended))
-    sequence = np.vstack(session_seqs)
-    assert sequence.shape == (8, 103)
-
-    h5save('sequence_final_{0}.hdf5'.format(participant), sequence)
+                break
+        sequence_two = sequence
+        sequence_two_id = matching_seq_ids[i]
+        print("Found good matching sequence (number {0})".format(matching_seq_ids[i]))
+
+        assert sequence_one[0] == sequence_two[0]
+        assert not np.array_equal(sequence_one, sequence_two)
+
+        # Print sequences
+        print("Session one sequence (efficiency = {0}):\n{1}".format(
+                dict(zip(model_names, efficiencies[sequence_one_id])), sequence_one))
+        print("Session two sequence (efficiency = {0}):\n{1}".format(
+                dict(zip(model_names, efficiencies[sequence_two_id])), sequence_two))
+
+        # Store optimized sequences for sessions 1 and 2; appending checks
+        # that no participant or session shares a sequence
+        append_design(store, participant, 1, sequence_one,
+                      efficiencies[sequence_one_id], seed=participant)
+        append_design(store, participant, 2, sequence_two,
+                      efficiencies[sequence_two_id], seed=participant)
+
+    save_store(store, store_fn)
+
+    # Compile sequence
+    for participant in range(1, 31):
+        sequence = participant_runs(store, participant)
+        assert sequence.shape == (8, 103)
+
+        h5save('sequence_final_{0}.hdf5'.format(participant), sequence)
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+
+# Benchmark the T1I1 design search: EvaluateSeqshard permutation throughput
+# and peak memory over the hard-coded sequence sizes, permutation counts,
+# numbers of model RDMs and blank handling, on seeded random RDMs.
+# Run with: benchmark_sequences.py benchmark_<commit>.json
+# Compare with an earlier run (speed and identical bestEs at the same seeds):
+# benchmark_sequences.py benchmark_<new>.json --compare benchmark_<old>.json
+# Extra EvaluateSeqshard parameters: --par batchsize=100 --par method=rfft
+# Runs under Python 2 for the original evalseqshard.py, without peak memory
+
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import hashlib
+import inspect
+import argparse
+import platform
+import itertools
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+from subprocess import check_output, STDOUT
+import numpy as np
+import evalseqshard
+from evalseqshard import EvaluateSeqshard
+
+Ns = [6, 10, 14, 20, 28]
+perms = [200, 1000]
+n_rdms = [1, 4]
+doubleblanks = [False, True]
+
+# Relative tolerance for bestEs to count as identical across commits
+tolerance = 1e-10
+
+# Trial length in seconds of the clips the designs are for
+trial_duration = 2.5
+
+
+def fixture_rdms(N, n_rdm, seed=0):
+    """Seeded random symmetric RDMs for labels 1 to N - 1"""
+    rng = np.random.RandomState(seed)
+    rdms = rng.rand(N - 1, N - 1, n_rdm)
+    rdms = (rdms + rdms.transpose(1, 0, 2)) / 2
+    for i in range(n_rdm):
+        np.fill_diagonal(rdms[:, :, i], 0)
+    return rdms
+
+
+def parse_value(value):
+    """Read a --par value as JSON if possible, otherwise as a string"""
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
+def evaluate(parameters, rdms, seed):
+    """EvaluateSeqshard on a stream seeded with seed; implementations without
+    an rng argument draw from numpy.random, which is seeded the same way"""
+    if hasattr(inspect, 'signature'):
+        arguments = inspect.signature(EvaluateSeqshard).parameters
+    else:
+        arguments = inspect.getargspec(EvaluateSeqshard).args
+    if 'rng' in arguments:
+        return EvaluateSeqshard(parameters, rdms, rng=np.random.RandomState(seed))
+    np.random.seed(seed)
+    return EvaluateSeqshard(parameters, rdms)
+
+
+def run_case(N, n_perms, n_rdm, blanks, extra_parameters, repeats, seed=0):
+    """Time one configuration, then measure its peak memory in a separate run"""
+    parameters = {'N': N,
+                  'perms': n_perms,
+                  'TrialDuration': trial_duration,
+                  'BlankLength': 1,
+                  'doubleblanks': blanks,
+                  'target': N - 1,
+                  'numSeqs': 10}
+    parameters.update(extra_parameters)
+    rdms = fixture_rdms(N, n_rdm, seed)
+    case = {'N': N, 'perms': n_perms, 'nSimMats': n_rdm,
+            'doubleblanks': blanks}
+
+    # First run builds the endogenous kernel, later ones reuse it (where
+    # the implementation caches kernels)
+    getattr(evalseqshard, 'kernelcache', {}).clear()
+    seconds = []
+    try:
+        for repeat in range(repeats + 1):
+            start = time.time()
+            result = evaluate(parameters, rdms, seed)
+            seconds.append(time.time() - start)
+    except Exception as error:
+        case['error'] = '{0}: {1}'.format(type(error).__name__, error)
+        return case
+
+    if tracemalloc is not None:
+        tracemalloc.start()
+        evaluate(parameters, rdms, seed)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        case['peak_mb'] = peak / 2.**20
+
+    best_seqs = np.ascontiguousarray(result['BestSeqs'], dtype=np.int64)
+    case['cold_seconds'] = seconds[0]
+    case['seconds'] = min(seconds[1:]) if repeats else seconds[0]
+    case['perms_per_second'] = n_perms / case['seconds']
+    case['bestEs'] = np.real(result['bestEs']).tolist()
+    case['BestSeqs_sha1'] = hashlib.sha1(best_seqs.tobytes()).hexdigest()
+    return case
+
+
+def case_key(case):
+    return (case['N'], case['perms'], case['nSimMats'], case['doubleblanks'])
+
+
+def compare(results, baseline):
+    """Print speedups against a baseline run; return False if any output changed"""
+    baseline_cases = {case_key(case): case for case in baseline['cases']}
+    identical = True
+    print("{0:>4} {1:>6} {2:>4} {3:>5} {4:>10} {5:>10} {6:>8} {7:>9}".format(
+        'N', 'perms', 'RDMs', 'blank', 'old s', 'new s', 'speedup', 'bestEs'))
+    for case in results['cases']:
+        old = baseline_cases.get(case_key(case))
+        if old is None or 'error' in case or 'error' in old:
+            continue
+        same = (old['BestSeqs_sha1'] == case['BestSeqs_sha1'] and
+                np.allclose(old['bestEs'], case['bestEs'], rtol=tolerance, atol=0))
+        identical = identical and same
+        print("{0:>4} {1:>6} {2:>4} {3:>5} {4:>10.4f} {5:>10.4f} {6:>7.2f}x {7:>9}".format(
+            case['N'], case['perms'], case['nSimMats'], str(case['doubleblanks']),
+            old['seconds'], case['seconds'], old['seconds'] / case['seconds'],
+            'same' if same else 'CHANGED'))
+    return identical
+
+
+def search_driver_seconds(n_perms):
+    """Time the T1I1_sequence.py search for one participant"""
+    import T1I1_sequence
+    T1I1_sequence.parameters['perms'] = n_perms
+    start = time.time()
+    T1I1_sequence.search_participants([1])
+    return time.time() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the T1I1 design search")
+    parser.add_argument('output', help="JSON file to write results to")
+    parser.add_argument('--compare', help="earlier JSON results to compare against")
+    parser.add_argument('--par', action='append', default=[],
+                        help="extra EvaluateSeqshard parameter as key=value")
+    parser.add_argument('--N', type=int, nargs='+', default=Ns)
+    parser.add_argument('--perms', type=int, nargs='+', default=perms)
+    parser.add_argument('--nSimMats', type=int, nargs='+', default=n_rdms)
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--driver', type=int, metavar='PERMS',
+                        help="also time the T1I1_sequence.py search with PERMS permutations")
+    args = parser.parse_args()
+
+    extra_parameters = dict((key, parse_value(value)) for key, value in
+                            (par.split('=', 1) for par in args.par))
+
+    try:
+        commit = check_output(['git', 'rev-parse', 'HEAD'], stderr=STDOUT,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except Exception:
+        commit = None
+
+    results = {'commit': commit,
+               'python': platform.python_version(),
+               'numpy': np.__version__,
+               'parameters': extra_parameters,
+               'cases': []}
+    for N, n_perms, n_rdm, blanks in itertools.product(args.N, args.perms,
+                                                       args.nSimMats, doubleblanks):
+        case = run_case(N, n_perms, n_rdm, blanks, extra_parameters, args.repeats)
+        results['cases'].append(case)
+        if 'error' in case:
+            print("N={0} perms={1} nSimMats={2} doubleblanks={3}: {4}".format(
+                N, n_perms, n_rdm, blanks, case['error']))
+        else:
+            print("N={0} perms={1} nSimMats={2} doubleblanks={3}: "
+                  "{4:.0f} perms/s, {5} MB".format(
+                      N, n_perms, n_rdm, blanks, case['perms_per_second'],
+                      '{0:.1f}'.format(case['peak_mb']) if 'peak_mb' in case else 'n/a'))
+
+    if args.driver:
+        results['driver_seconds'] = search_driver_seconds(args.driver)
+        print("T1I1_sequence.py search, {0} perms: {1:.2f} s".format(
+            args.driver, results['driver_seconds']))
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if not compare(results, baseline):
+            print("bestEs or BestSeqs changed relative to {0}".format(args.compare))
+            sys.exit(1)
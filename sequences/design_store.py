@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+# Columnar store for T1I1 sequence designs, kept in a single NPZ file with
+# one row per participant and session: the full sequence, its four runs (each
+# prefixed with the last three trials of the previous run), the efficiency of
+# the sequence under each model RDM, and the seed it was searched with. A hash
+# index over the sequences (without the first trial, which the two sessions
+# share) makes uniqueness checks O(n) instead of pairwise comparisons.
+# Every row has one efficiency per model RDM, so all rows in a store have
+# the same number of models. Legacy sequence_subject{p}_session{s}.txt files
+# can be imported, with NaN efficiencies for the store's models.
+
+import os
+import hashlib
+from glob import glob
+import numpy as np
+
+columns = ['participant', 'session', 'seed', 'sequence', 'runs', 'efficiencies']
+
+n_runs = 4
+n_overlap = 3
+
+
+def sequence_hash(sequence):
+    """Hash of a sequence without its first trial"""
+    sequence = np.ascontiguousarray(sequence[1:], dtype=np.int64)
+    return hashlib.sha1(sequence.tobytes()).hexdigest()
+
+
+def session_runs(sequence):
+    """Split a session sequence (without its first trial) into runs, each
+    prefixed with the last trials of the previous run (the last run for the
+    first run)"""
+    run_seqs = np.split(np.asarray(sequence[1:], dtype=int), n_runs)
+    extended = [np.append(run_seqs[-1][-n_overlap:], run_seqs[0])]
+    for i in range(1, len(run_seqs)):
+        extended.append(np.append(run_seqs[i - 1][-n_overlap:], run_seqs[i]))
+    return np.array(extended)
+
+
+def new_store():
+    """Empty store: a list per column plus the hash index"""
+    store = {column: [] for column in columns}
+    store['index'] = {}
+    return store
+
+
+def load_store(store_fn):
+    """Load a store written by save_store, or an empty one if there is none"""
+    store = new_store()
+    if not os.path.exists(store_fn):
+        return store
+    with np.load(store_fn) as saved:
+        for column in columns:
+            store[column] = list(saved[column])
+    for row, sequence in enumerate(store['sequence']):
+        store['index'][sequence_hash(sequence)] = row
+    return store
+
+
+def save_store(store, store_fn):
+    """Write every column to one NPZ file, replacing it atomically"""
+    tmp_fn = '{0}.{1}'.format(store_fn, os.getpid())
+    with open(tmp_fn, 'wb') as f:
+        np.savez(f, **{column: np.array(store[column]) for column in columns})
+    os.rename(tmp_fn, store_fn)
+
+
+def store_models(store):
+    """Number of model efficiencies per row, or None for an empty store"""
+    if not store['efficiencies']:
+        return None
+    return len(store['efficiencies'][0])
+
+
+def append_design(store, participant, session, sequence, efficiencies, seed):
+    """Add a session's sequence, raising ValueError if it is already stored
+    or has efficiencies for a different number of models than the store"""
+    efficiencies = np.atleast_1d(np.asarray(efficiencies, dtype=float))
+    n_models = store_models(store)
+    if n_models is not None and len(efficiencies) != n_models:
+        raise ValueError("Sequence for participant {0} session {1} has {2} "
+                         "efficiencies, but the store has {3} models".format(
+                             participant, session, len(efficiencies), n_models))
+    key = sequence_hash(sequence)
+    if key in store['index']:
+        row = store['index'][key]
+        raise ValueError("Sequence for participant {0} session {1} duplicates "
+                         "participant {2} session {3}".format(
+                             participant, session, store['participant'][row],
+                             store['session'][row]))
+    store['index'][key] = len(store['sequence'])
+    store['participant'].append(participant)
+    store['session'].append(session)
+    store['seed'].append(seed)
+    store['sequence'].append(np.asarray(sequence, dtype=int))
+    store['runs'].append(session_runs(sequence))
+    store['efficiencies'].append(efficiencies)
+
+
+def contains_sequence(store, sequence):
+    return sequence_hash(sequence) in store['index']
+
+
+def participant_rows(store, participant):
+    """Rows of a participant's designs, in session order"""
+    rows = [row for row, p in enumerate(store['participant']) if p == participant]
+    return sorted(rows, key=lambda row: store['session'][row])
+
+
+def participant_runs(store, participant):
+    """All runs of a participant's sessions stacked (runs x trials), as saved
+    in sequence_final_{p}.hdf5"""
+    return np.vstack([store['runs'][row] for row in participant_rows(store, participant)])
+
+
+def import_sequence_files(store, sequence_dir, n_models=None):
+    """Append legacy sequence_subject{p}_session{s}.txt files, which record
+    neither efficiencies (stored as NaN for each of n_models, by default the
+    store's models or else one) nor seeds (stored as -1)"""
+    if n_models is None:
+        n_models = store_models(store) or 1
+    fns = glob(os.path.join(sequence_dir, 'sequence_subject*_session*.txt'))
+    designs = []
+    for fn in fns:
+        participant, session = os.path.basename(fn)[len('sequence_subject'):-len('.txt')].split('_session')
+        designs.append((int(participant), int(session), fn))
+    for participant, session, fn in sorted(designs):
+        with open(fn) as f:
+            sequence = [int(line) for line in f.readlines()]
+        append_design(store, participant, session, sequence,
+                      np.full(n_models, np.nan), -1)
+    return store
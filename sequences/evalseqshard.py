@@ -2,26 +2,34 @@
 # sequence evaluator for fmri experiments
 # Daniel M. Drucker, 2008-2010 dmd@3e.org
 
+from __future__ import print_function
 import sys
 sys.path.append('/home/aguirre/local/lib64/python2.4/site-packages/')
 import cgi
 import cgitb
 import re
 import datetime
+import heapq
+import os
 from numpy import *
-from numpy.fft import fft,ifft
+from numpy.fft import fft,ifft,rfft
 from pygments import highlight
 from pygments.lexers import PythonLexer
 from pygments.formatters import HtmlFormatter
 
 cgitb.enable()
 
+# endogenous kernels already built in this process, keyed by
+# (seqtype, N, TrialDuration, ResolutionHz, doubleblanks)
+kernelcache = {}
+
 def vec2sim(vec):
     [15,21,28,36,45,55,66,78,91,105,120,136,153,171,190,210,231,253,276,300,325,351,378]
     msize=.5+.5*sqrt(1+8*vec.size)
     if msize != int(msize):
-        print 'one of your similarity vectors was of incorrect length, exiting'
+        print('one of your similarity vectors was of incorrect length, exiting')
         sys.exit()
+    msize=int(msize)
     m=zeros((msize,msize))
     CP=triu(ones((msize,msize)),1).nonzero()
     for tup in zip(CP[0],CP[1],vec):
@@ -38,12 +46,12 @@ def eucsum(x):
     return sqrt(sum(x**2,axis=0))
 
 def congrid(Signal,NewSize):
-    return Signal.repeat(NewSize/Signal.shape[0],axis=0)
+    return Signal.repeat(int(NewSize)//Signal.shape[0],axis=0)
     
     
 def mncn(m):
     m = asfarray(m)
-    return m-sum(m.flatten(1))/m.size
+    return m-sum(m.flatten('F'))/m.size
 
 def NormMag(Image):
     FTImage=fft(Image)
@@ -76,15 +84,360 @@ def ztransform(vec):
     zt = mncn(vec)
     return zt/std(zt)
 
-def EvaluateSeqshard(par,SimMat):
+def kernelfile(kerneldir,key):
+    return os.path.join(kerneldir,'kernel_%s_N%d_TD%g_R%g_db%d.npy' % key)
+
+def endogenouskernel(key,EndogenousFilter,EndoLength,kerneldir=None):
+    ''' Return the FFT of the zero-padded, magnitude-normalized EndogenousFilter
+        as an EndoLength x 1 column. Kernels are memoized in kernelcache and, if
+        kerneldir is given, saved there as .npy files for later processes. '''
+    if key in kernelcache:
+        return kernelcache[key]
+    if kerneldir is not None and os.path.exists(kernelfile(kerneldir,key)):
+        EndogenousKernel = load(kernelfile(kerneldir,key))
+    else:
+        EndogenousFilter=hstack((EndogenousFilter, zeros(EndoLength-EndogenousFilter.size)))
+        EndogenousFilter=NormMag(mncn(EndogenousFilter))
+        EndogenousKernel=fft(EndogenousFilter)
+        EndogenousKernel[0]=1   # set DC component to pin amplitude
+        EndogenousKernel=EndogenousKernel.reshape(EndogenousKernel.size,1)
+        if kerneldir is not None:
+            if not os.path.isdir(kerneldir):
+                os.makedirs(kerneldir)
+            # write then rename so parallel workers never load a partial file
+            tmpfile = '%s.%d' % (kernelfile(kerneldir,key),os.getpid())
+            with open(tmpfile,'wb') as f:
+                save(f,EndogenousKernel)
+            os.rename(tmpfile,kernelfile(kerneldir,key))
+    EndogenousKernel.flags.writeable = False
+    kernelcache[key] = EndogenousKernel
+    return EndogenousKernel
+
+def aliasedweights(EndogenousKernel,ResolutionScale):
+    ''' |fft(boxcar)|^2 |EndogenousKernel|^2 / EndogenousKernel.size, summed over
+        the aliases of each fft bin of a vector ResolutionScale times shorter. '''
+    FullLength = EndogenousKernel.size
+    Length = FullLength // ResolutionScale
+    Boxcar = zeros(FullLength)
+    Boxcar[:ResolutionScale] = 1
+    Weights = (abs(fft(Boxcar))**2 * abs(EndogenousKernel.ravel())**2).reshape(ResolutionScale,Length).sum(axis=0)
+    return Weights / FullLength
+
+def rfftweights(Weights):
+    ''' Per-fft-bin weights on the rfft bins of a real vector: real input has a
+        symmetric spectrum, so the mirrored bins count twice. '''
+    Length = Weights.size
+    Weights = Weights[:Length//2+1].copy()
+    Weights[1:(Length+1)//2] *= 2
+    Weights.flags.writeable = False
+    return Weights
+
+def efficiencyweights(key,EndogenousKernel,ResolutionScale):
+    ''' Fold |fft(boxcar)|^2 |EndogenousKernel|^2 onto the rfft bins of a vector
+        that is upsampled by ResolutionScale before filtering, so efficiencybatch
+        can score the vector at trial resolution. Memoized in kernelcache. '''
+    if key + ('rfft',) not in kernelcache:
+        kernelcache[key + ('rfft',)] = rfftweights(aliasedweights(EndogenousKernel,ResolutionScale))
+    return kernelcache[key + ('rfft',)]
+
+def fullweights(key,EndogenousKernel):
+    ''' |EndogenousKernel|^2 / EndogenousKernel.size on the rfft bins of a
+        full-resolution vector, so its filtered energy is a weighted sum of its
+        power spectrum (Parseval) without the inverse FFT. Memoized in kernelcache. '''
+    if key + ('full',) not in kernelcache:
+        kernelcache[key + ('full',)] = rfftweights(abs(EndogenousKernel.ravel())**2 / EndogenousKernel.size)
+    return kernelcache[key + ('full',)]
+
+def circulantweights(key,EndogenousKernel,ResolutionScale):
+    ''' The symmetric circulant matrix C for which x'Cx is the filtered energy of
+        the trial-rate vector x upsampled by ResolutionScale, i.e. the numerator
+        of E before the ResolutionScale factor. Memoized in kernelcache. '''
+    if key + ('circulant',) in kernelcache:
+        return kernelcache[key + ('circulant',)]
+    Column = real(fft(aliasedweights(EndogenousKernel,ResolutionScale)))
+    Lags = arange(Column.size)
+    Circulant = Column[(Lags[:,newaxis] - Lags[newaxis,:]) % Column.size]
+    Circulant.flags.writeable = False
+    kernelcache[key + ('circulant',)] = Circulant
+    return Circulant
+
+def efficiencybatch(FullVecs,Weights,ResolutionScale):
+    ''' Efficiency of each perms x trials-1 x nSimMats transition vector after
+        upsampling by ResolutionScale and circular filtering with the kernel
+        that Weights summarizes (see efficiencyweights), as perms x nSimMats. '''
+    Power = abs(rfft(FullVecs,axis=1))**2
+    return tensordot(Power,Weights,axes=([1],[0])) / (ResolutionScale * sum(FullVecs**2,axis=1))
+
+def relabelings(n,count,rng=random):
+    ''' Draw count permutations of range(n) that do not map 0 to 0, one per
+        row, consuming the random stream exactly as the per-permutation loop does. '''
+    Relabels = zeros((count,n),dtype=int)
+    for i in range(count):
+        while True:
+            Relabel=rng.permutation(n)
+            if Relabel[0] != 0:
+                break
+        Relabels[i] = Relabel
+    return Relabels
+
+def relabelbatch(PSeq,Relabels,doubleblanks):
+    ''' Apply each row of Relabels to PSeq, expanding blanks to [0,0] if doubleblanks. '''
+    QSeqs = Relabels[:,PSeq]
+    if doubleblanks:
+        counts = where(QSeqs == 0,2,1)
+        QSeqs = QSeqs.ravel().repeat(counts.ravel()).reshape(QSeqs.shape[0],-1)
+    return QSeqs
+
+def transitionvalues(From,To,SimMat,target):
+    ''' SimMat entries (nStims x nStims x nSimMats) for transitions From -> To,
+        as From.shape x nSimMats. Transitions into or out of a blank or the
+        target, and repeats, are zero. '''
+    valid = (From != 0) & (To != 0) & (From != target) & (To != target) & (From != To)
+    Values = SimMat[clip(From-1,0,SimMat.shape[0]-1),clip(To-1,0,SimMat.shape[1]-1)]
+    Values[~valid] = 0
+    return Values
+
+def transitionbatch(QSeqs,SimMat,target):
+    ''' Gather SimMat transitions for a batch of sequences (perms x trials) into
+        a perms x trials-1 x nSimMats array (see transitionvalues). '''
+    SimMat = SimMat.reshape(SimMat.shape[0],SimMat.shape[1],-1)
+    return transitionvalues(QSeqs[:,:-1],QSeqs[:,1:],SimMat,target)
+
+def seqkey(QSeq,target):
+    ''' QSeq as bytes with the target written as a blank, so sequences that
+        differ only by exchanging blanks and the target (which transitionvalues
+        scores alike) share a key. '''
+    return where(QSeq == target,0,QSeq).astype(uint8).tobytes()
+
+def pushbest(heap,numSeqs,Effs,QSeqs,Start,seen=None,target=0):
+    ''' Keep the numSeqs best permutations on a min-heap of
+        (sum of efficiencies, permutation, efficiencies, uint8 sequence) entries.
+        Effs is nSimMats x perms and QSeqs is perms x trials, starting at
+        permutation Start; ties favor later permutations, as the full sort does.
+        If seen is a set, it tracks the sequences on the heap (by seqkey) and
+        repeats of them are skipped. '''
+    sumofeffs = eucsum(Effs)
+    if len(heap) < numSeqs:
+        candidates = range(sumofeffs.size)
+    else:
+        candidates = (sumofeffs >= heap[0][0]).nonzero()[0]
+    for i in candidates:
+        entry = (sumofeffs[i],Start + i,Effs[:,i].copy(),QSeqs[i].astype(uint8))
+        if seen is not None:
+            if seqkey(entry[3],target) in seen:
+                continue
+        if len(heap) < numSeqs:
+            heapq.heappush(heap,entry)
+        elif entry[:2] > heap[0][:2]:
+            if seen is not None:
+                seen.discard(seqkey(heap[0][3],target))
+            heapq.heapreplace(heap,entry)
+        else:
+            continue
+        if seen is not None:
+            seen.add(seqkey(entry[3],target))
+
+def mncnleavezerosbatch(FullVecs):
+    ''' mncnleavezeros along axis 1, skipping columns whose range is exactly 1. '''
+    nonzeros = FullVecs != 0
+    counts = nonzeros.sum(axis=1)
+    means = FullVecs.sum(axis=1) / maximum(counts,1)
+    center = (FullVecs.max(axis=1) - FullVecs.min(axis=1)) != 1
+    return where(nonzeros & center[:,newaxis,:], FullVecs - means[:,newaxis,:], FullVecs)
+
+def labelindex(PSeq):
+    ''' For each label of PSeq, the positions it occupies and the indices of the
+        transitions (into FullVec) those positions take part in. pairs[i,j], for
+        labels i < j, holds the union of the two labels' transitions and the base
+        labels on either side of them, which is all swaptransitions needs. Not
+        valid with doubleblanks, where the expansion depends on the relabeling. '''
+    Length = PSeq.size - 1
+    index = {'positions': [], 'transitions': [], 'pairs': {}}
+    for label in range(PSeq.max() + 1):
+        positions = (PSeq == label).nonzero()[0]
+        transitions = union1d(positions - 1,positions)
+        index['positions'].append(positions)
+        index['transitions'].append(transitions[(transitions >= 0) & (transitions < Length)])
+    for i in range(len(index['transitions'])):
+        for j in range(i + 1,len(index['transitions'])):
+            Changed = union1d(index['transitions'][i],index['transitions'][j])
+            index['pairs'][i,j] = (Changed,PSeq[Changed],PSeq[Changed + 1])
+    return index
+
+def swaptransitions(index,Trial,i,j,SimMat,target):
+    ''' The transitions that change when a relabeling exchanges what base labels
+        i and j map to, as their indices into FullVec and their values under
+        Trial, the relabeling after the exchange (see transitionvalues). Costs
+        time proportional to the occurrences of i and j, not to the sequence. '''
+    Changed,From,To = index['pairs'][min(i,j),max(i,j)]
+    return Changed,transitionvalues(Trial[From],Trial[To],SimMat,target)
+
+def quadstate(FullVec,Circulant):
+    ''' Bookkeeping for scoring a raw (not yet mean centered) trials-1 x nSimMats
+        transition vector r through the quadratic form C (see circulantweights).
+        Vecs stacks r and its nonzero mask z, and Gram holds Vecs'C Vecs, whose
+        diagonal blocks give r'Cr, z'Cr and z'Cz; the sums, count, max and min
+        are what mncnleavezeros depends on. quaddelta updates it as transitions
+        change. '''
+    state = {}
+    state['Vecs'] = hstack((FullVec,FullVec != 0))
+    state['CVecs'] = dot(Circulant,state['Vecs'])
+    state['Gram'] = dot(state['Vecs'].T,state['CVecs'])
+    state['sum'] = FullVec.sum(axis=0)
+    state['sumsq'] = (FullVec**2).sum(axis=0)
+    state['count'] = (FullVec != 0).sum(axis=0)
+    state['max'] = FullVec.max(axis=0)
+    state['min'] = FullVec.min(axis=0)
+    return state
+
+def quaddelta(state,Changed,Values,Circulant):
+    ''' The scalar entries of quadstate once the transitions at indices Changed
+        are set to Values (len(Changed) x nSimMats), without changing state. Costs
+        len(Changed)^2 per SimMat instead of a pass over the whole vector; only
+        a change that lowers the max or raises the min rescans the vector. '''
+    nSimMats = Values.shape[1]
+    Old = state['Vecs'][Changed]
+    Delta = hstack((Values,Values != 0)) - Old
+    Cross = dot(Delta.T,state['CVecs'][Changed])
+    stats = {}
+    stats['Gram'] = state['Gram'] + Cross + Cross.T + dot(Delta.T,dot(Circulant[Changed][:,Changed],Delta))
+    stats['sum'] = state['sum'] + Delta[:,:nSimMats].sum(axis=0)
+    stats['sumsq'] = state['sumsq'] + (Values**2 - Old[:,:nSimMats]**2).sum(axis=0)
+    stats['count'] = state['count'] + Delta[:,nSimMats:].sum(axis=0)
+    stats['max'] = maximum(state['max'],Values.max(axis=0))
+    stats['min'] = minimum(state['min'],Values.min(axis=0))
+    if any((Old[:,:nSimMats].max(axis=0) == state['max']) & (Values.max(axis=0) < state['max'])) or \
+       any((Old[:,:nSimMats].min(axis=0) == state['min']) & (Values.min(axis=0) > state['min'])):
+        Patched = state['Vecs'][:,:nSimMats].copy()
+        Patched[Changed] = Values
+        stats['max'] = Patched.max(axis=0)
+        stats['min'] = Patched.min(axis=0)
+    return stats
+
+def quadapply(state,Changed,Values,Circulant,stats):
+    ''' Commit a change scored by quaddelta to state. '''
+    New = hstack((Values,Values != 0))
+    state['CVecs'] += dot(Circulant[:,Changed],New - state['Vecs'][Changed])
+    state['Vecs'][Changed] = New
+    state.update(stats)
+
+def quadefficiency(stats,ResolutionScale):
+    ''' E for each SimMat from quadstate or quaddelta entries, mean centering the
+        nonzero transitions of columns whose range is not 1 as mncnleavezerosbatch does. '''
+    r = arange(stats['sum'].size)
+    z = r + r.size
+    means = stats['sum'] / maximum(stats['count'],1)
+    center = (stats['max'] - stats['min']) != 1
+    Gram = stats['Gram']
+    numerator = where(center,Gram[r,r] - 2*means*Gram[z,r] + means**2*Gram[z,z],Gram[r,r])
+    energy = where(center,stats['sumsq'] - stats['count']*means**2,stats['sumsq'])
+    return numerator / (ResolutionScale * energy)
+
+def annealseqshard(par,SimMat,PSeq,Weights,Circulant,ResolutionScale,rng=random):
+    ''' Simulated annealing over relabelings of PSeq, for EvaluateSeqshard.
+        Each proposal swaps the labels of two base labels and is scored from the
+        transitions it changes only (swaptransitions and quaddelta). The first tenth of each chain
+        accepts every proposal and sets the starting temperature to the mean
+        change in summed efficiency, unless par['temperature'] is given; the
+        temperature then cools geometrically by par['cooling'] over the chain.
+        Swaps between the blank and the target change nothing and are skipped.
+        The numSeqs best distinct sequences visited (see seqkey) are rescored
+        exactly. '''
+    if par['doubleblanks']:
+        raise ValueError('annealing does not support doubleblanks')
+    SimMat = SimMat.reshape(SimMat.shape[0],SimMat.shape[1],-1)
+    p = PSeq.max()
+    index = labelindex(PSeq)
+    chains = par.get('chains',1)
+    cooling = par.get('cooling',1e-3)
+    heap = []
+    seen = set()
+    Proposal = 0
+    for chain in range(chains):
+        steps = par['perms'] // chains + (chain < par['perms'] % chains)
+        Relabel = relabelings(p+1,1,rng)[0]
+        state = quadstate(transitionbatch(Relabel[PSeq][newaxis],SimMat,par['target'])[0],Circulant)
+        E = quadefficiency(state,ResolutionScale)
+        pushbest(heap,par['numSeqs'],E[:,newaxis],Relabel[PSeq][newaxis],Proposal,seen,par['target'])
+        StartTemperature = par.get('temperature')
+        if StartTemperature is None:
+            Warmup = steps // 10
+            Changes = []
+        else:
+            Warmup = 0
+        Accepted = 0
+        for step in range(steps):
+            Proposal += 1
+            i,j = rng.choice(p+1,2,replace=False)
+            # exchanging the blank and the target changes no transition
+            if sorted((Relabel[i],Relabel[j])) == sorted((0,par['target'])):
+                continue
+            Trial = Relabel.copy()
+            Trial[[i,j]] = Relabel[[j,i]]
+            if Trial[0] == 0:
+                continue
+            Changed,Values = swaptransitions(index,Trial,i,j,SimMat,par['target'])
+            stats = quaddelta(state,Changed,Values,Circulant)
+            NewE = quadefficiency(stats,ResolutionScale)
+            Change = eucsum(NewE) - eucsum(E)
+            if step < Warmup:
+                Changes.append(abs(Change))
+            else:
+                if StartTemperature is None:
+                    StartTemperature = max(mean(Changes),finfo(float).tiny) if Changes else 1.
+                Temperature = StartTemperature * cooling**((step - Warmup) / float(steps - Warmup))
+                if Change < 0 and rng.random() >= exp(Change / Temperature):
+                    continue
+            quadapply(state,Changed,Values,Circulant,stats)
+            Relabel = Trial
+            E = NewE
+            pushbest(heap,par['numSeqs'],E[:,newaxis],Relabel[PSeq][newaxis],Proposal,seen,par['target'])
+            Accepted += 1
+            # recompute from scratch now and then so rounding cannot accumulate
+            if Accepted % 1000 == 0:
+                state = quadstate(state['Vecs'][:,:E.size],Circulant)
+
+    heap.sort()
+    QSeqs = array([entry[3] for entry in heap])
+    assert len(set(seqkey(QSeq,par['target']) for QSeq in QSeqs)) == len(QSeqs)
+    FullVecs = mncnleavezerosbatch(transitionbatch(QSeqs.astype(int),SimMat,par['target']))
+    Es = efficiencybatch(FullVecs,Weights,ResolutionScale)
+    sortedsumofeffs_index = argsort(eucsum(Es.T),kind='mergesort')
+
+    result = {}
+    result['BestVec'] = FullVecs[sortedsumofeffs_index[-1]].repeat(ResolutionScale,axis=0)
+    result['bestEs'] = Es[sortedsumofeffs_index].T
+    result['BestSeqs'] = QSeqs[sortedsumofeffs_index].T
+    return result
+
+def EvaluateSeqshard(par,SimMat,rng=random):
     ''' Evaluate mapping of sequence labels for maximum efficiency given a set of similarity matrices.
          
           Daniel M. Drucker <ddrucker@psych.upenn.edu>
+          SimMat               = similarity matrix indexed by label-1, with an
+                                 optional third axis of nSimMats models; bestEs
+                                 has a row of efficiencies per model and sequences
+                                 are ranked by the euclidean sum over models
           par['N']             = N stims
           par['perms']         = how many permutations to try
           par['TrialDuration'] = length of stimulus in secs
           par['BlankLength']   = number of blanks to insert for each blank
-          par['target']        = id of target '''
+          par['target']        = id of target
+          par['batchsize']     = if set, evaluate this many permutations at a time
+                                 as 2-D arrays (same random stream and results)
+          par['streaming']     = if set, keep only the numSeqs best sequences (as
+                                 uint8 labels) instead of every permutation
+          par['kerneldir']     = if set, directory to cache endogenous kernels in
+          par['method']        = 'fft' (default) filters the upsampled vectors at
+                                 full resolution; 'rfft' scores the trial-rate
+                                 vectors with real FFTs (same E to rounding)
+          par['optimizer']     = 'random' (default) samples perms relabelings;
+                                 'anneal' spends them on simulated annealing
+                                 (see annealseqshard), optionally with
+                                 par['chains'], par['temperature'] and par['cooling']
+
+          rng may be a numpy Generator (or RandomState) to draw relabelings from
+          instead of the global numpy.random stream. '''
 
 #    blanks = [int(x) for x in zeros(par.get('BlankLength',2))]
     blanks = [0,0]
@@ -132,109 +485,172 @@ def EvaluateSeqshard(par,SimMat):
         blanksinseq = 0
 
     # Load the Endogenous Filter
-    EndoLength=(PSeq.size - 1 + blanksinseq) * par['TrialDuration'] * ResolutionHz
-    EndogenousFilter=hstack((EndogenousFilter, array(zeros((EndoLength-EndogenousFilter.size))).T.flatten(1)))
-    EndogenousFilter=NormMag(mncn(EndogenousFilter))
-    EndogenousKernel=fft(EndogenousFilter)
-    EndogenousKernel[0]=1   # set DC component to pin amplitude
-    EndogenousKernel.resize(EndogenousKernel.size,1)
+    EndoLength=int(round((PSeq.size - 1 + blanksinseq) * par['TrialDuration'] * ResolutionHz))
+    kernelkey=(par.get('seqtype','t1i1'),par['N'],par['TrialDuration'],ResolutionHz,bool(par['doubleblanks']))
+    EndogenousKernel=endogenouskernel(kernelkey,EndogenousFilter,EndoLength,par.get('kerneldir'))
+    ResolutionScale = int(round(par['TrialDuration'] * ResolutionHz))
+    fastE = par.get('method','fft') == 'rfft'
+    if fastE:
+        Weights = efficiencyweights(kernelkey,EndogenousKernel,ResolutionScale)
+    elif par.get('batchsize',0):
+        FullWeights = fullweights(kernelkey,EndogenousKernel)
+
+    if par.get('optimizer','random') == 'anneal':
+        return annealseqshard(par,SimMat,PSeq,efficiencyweights(kernelkey,EndogenousKernel,ResolutionScale),
+                              circulantweights(kernelkey,EndogenousKernel,ResolutionScale),ResolutionScale,rng)
     
     # NOW THE REAL WORK BEGINS
 
-    alleffs=zeros((nSimMats,par['perms']))
-    allseqs=zeros((PSeq.size+blanksinseq,par['perms']))
+    streaming = par.get('streaming',False)
+    if streaming:
+        heap = []
+    else:
+        alleffs=zeros((nSimMats,par['perms']))
+        allseqs=zeros((PSeq.size+blanksinseq,par['perms']))
     maxE=0
 
     # create a place to put the permed pseq
     PermedPSeq=zeros((PSeq.size,1))
 
-    for Perm in xrange(par['perms']):
-            
-        while True:
-            Relabel=random.permutation(p+1)
-            if Relabel[0] != 0:
-                break
+    batchsize = par.get('batchsize',0)
 
-        # iterate through all the values and put the new value
-        # in as assigned by relabel in the spot indicated by PSeq
-        for i in range(p+1):
-            PermedPSeq[PSeq==i]=Relabel[i]
-
-        # set the blank trials to zero and expand
-        if par['doubleblanks']:
-            QSeq = array([],dtype=int)
-            m = {0: blanks}
-            for i in PermedPSeq:
-                QSeq = append(QSeq,(m.get(int(i),[int(i)])))
-        else:
-            QSeq = array(PermedPSeq,dtype=int).flatten()
-        
-        NewLength=QSeq.size - 1  # differences vector is 1 smaller
-        FullVec = zeros((NewLength,nSimMats))
-    
-        for j in range(NewLength):
-            # NO elements in QSeq(j:j+1) may be zero or target
-            if ((0 not in QSeq[j:j+2]) and (par['target'] not in QSeq[j:j+2])):
-                FullVec[j,:] = SimMat[QSeq[j]-1,QSeq[j+1]-1,:]
-        
-            if QSeq[j] == QSeq[j+1] or QSeq[j] == 0 or QSeq[j+1] == 0 or QSeq[j] == par['target']:
-                FullVec[j,:] = -999
+    if batchsize:
+        for Start in range(0,par['perms'],batchsize):
+            Stop = min(Start + batchsize,par['perms'])
+            QSeqs = relabelbatch(PSeq,relabelings(p+1,Stop - Start,rng),par['doubleblanks'])
+            FullVecs = mncnleavezerosbatch(transitionbatch(QSeqs,SimMat,par['target']))
+
+            if fastE:
+                Es = efficiencybatch(FullVecs,Weights,ResolutionScale)
+            else:
+                # filter one SimMat at a time so the upsampled copies do not
+                # grow with nSimMats; the filtered energy is the real power
+                # spectrum weighted by the kernel's, so one rfft per vector
+                # replaces the complex fft/ifft pair of the per-permutation loop
+                Es = zeros((FullVecs.shape[0],nSimMats))
+                for n in range(nSimMats):
+                    Vecs = FullVecs[:,:,n].repeat(ResolutionScale,axis=1)
+                    Power = abs(rfft(Vecs,axis=1))**2
+                    Es[:,n] = dot(Power,FullWeights) / sum(Vecs**2,axis=1)
+            if streaming:
+                pushbest(heap,par['numSeqs'],real(Es).T,QSeqs,Start)
+            else:
+                alleffs[:,Start:Stop] = real(Es).T
+                allseqs[:,Start:Stop] = QSeqs.T
+
+            SumEs = real(eucsum(Es.T))
+            Best = argmax(SumEs)
+            if SumEs[Best] > maxE:
+                maxE = SumEs[Best]
+                maxeffidx = Start + Best
+                BestVec = FullVecs[Best].repeat(ResolutionScale,axis=0)
+
+    else:
+        for Perm in range(par['perms']):
+            
+            while True:
+                Relabel=rng.permutation(p+1)
+                if Relabel[0] != 0:
+                    break
 
-        FullVec[FullVec==-999] = 0
+            # iterate through all the values and put the new value
+            # in as assigned by relabel in the spot indicated by PSeq
+            for i in range(p+1):
+                PermedPSeq[PSeq==i]=Relabel[i]
 
+            # set the blank trials to zero and expand
+            if par['doubleblanks']:
+                QSeq = array([],dtype=int)
+                m = {0: blanks}
+                for i in PermedPSeq:
+                    QSeq = append(QSeq,(m.get(int(i),[int(i)])))
+            else:
+                QSeq = array(PermedPSeq,dtype=int).flatten()
         
-        # individually mean center
-        for n in range(nSimMats):
-            if mathrange(FullVec[:,n]) != 1:
-                FullVec[:,n]=mncnleavezeros(FullVec[:,n])
+            # differences vector is 1 smaller; NO elements in QSeq(j:j+1) may be
+            # zero or target, and repeats are zeroed too
+            FullVec = transitionbatch(QSeq[newaxis],SimMat,par['target'])[0]
+        
+            # individually mean center
+            for n in range(nSimMats):
+                if mathrange(FullVec[:,n]) != 1:
+                    FullVec[:,n]=mncnleavezeros(FullVec[:,n])
 
-        Vec=congrid(FullVec,FullVec.shape[0] * par['TrialDuration'] * ResolutionHz)
+            Vec=congrid(FullVec,FullVec.shape[0] * par['TrialDuration'] * ResolutionHz)
                 
-        FiltVec = ifft(fft(Vec,axis=0) * repmat(EndogenousKernel,(1,nSimMats)),axis=0)
+            if fastE:
+                FiltVec = None
+                E = efficiencybatch(FullVec[newaxis],Weights,ResolutionScale)[0]
+            else:
+                # the kernel column broadcasts over SimMats
+                FiltVec = ifft(fft(Vec,axis=0) * EndogenousKernel,axis=0)
         
-        E = sum(FiltVec**2,axis=0) / sum(Vec**2,axis=0)
-        alleffs[:,Perm] = real(E)
-        allseqs[:,Perm] = QSeq
+                E = sum(FiltVec**2,axis=0) / sum(Vec**2,axis=0)
+            if streaming:
+                pushbest(heap,par['numSeqs'],real(E)[:,newaxis],QSeq[newaxis],Perm)
+            else:
+                alleffs[:,Perm] = real(E)
+                allseqs[:,Perm] = QSeq
     
-        if eucsum(E.T) > maxE:
-            maxE = eucsum(E.T)
-            maxeffidx = Perm
-            BestVec = Vec
-            BestFiltVec = FiltVec
-#            print 'new best: ssqE %0.2f\t' % maxE,
-#            for x in E:
-#                print '%0.2f ' % x,
-#            print
-#        
-#        if mod(Perm,1000) == 0:
-#            print '--- (%2.0f%% done) ---' % floor(100 * Perm / par['perms'])
+            if eucsum(E.T) > maxE:
+                maxE = eucsum(E.T)
+                maxeffidx = Perm
+                BestVec = Vec
+                BestFiltVec = FiltVec
+#                print 'new best: ssqE %0.2f\t' % maxE,
+#                for x in E:
+#                    print '%0.2f ' % x,
+#                print
+#            
+#            if mod(Perm,1000) == 0:
+#                print '--- (%2.0f%% done) ---' % floor(100 * Perm / par['perms'])
     
 
 
-    sumofeffs = eucsum(alleffs)
-    zipeffs = zip(sumofeffs,range(sumofeffs.size))
-    sortedsumofeffs_index = [x[1] for x in sorted(zipeffs)]
-    
     result = {}
     result['BestVec'] = BestVec
-    result['bestEs'] = alleffs[:,sortedsumofeffs_index[-par['numSeqs']:]]
-    result['BestSeqs'] = allseqs[:,sortedsumofeffs_index[-par['numSeqs']:]]
+    if streaming:
+        heap.sort()
+        result['bestEs'] = array([entry[2] for entry in heap]).T
+        result['BestSeqs'] = array([entry[3] for entry in heap]).T
+    else:
+        sumofeffs = eucsum(alleffs)
+        zipeffs = zip(sumofeffs,range(sumofeffs.size))
+        sortedsumofeffs_index = [x[1] for x in sorted(zipeffs)]
+        result['bestEs'] = alleffs[:,sortedsumofeffs_index[-par['numSeqs']:]]
+        result['BestSeqs'] = allseqs[:,sortedsumofeffs_index[-par['numSeqs']:]]
 #    print 'Best was found on permutation %d of %d\n' % (maxeffidx,Perm)
     return result
-    
+
+def MergeSeqshards(results,numSeqs):
+    ''' Combine EvaluateSeqshard results from separate chunks of permutations into
+        one result holding the numSeqs best sequences, in the same ascending order.
+        Ties keep chunk order, so the merge depends only on how permutations were
+        chunked, not on which process evaluated them. '''
+    alleffs = hstack([result['bestEs'] for result in results])
+    allseqs = hstack([result['BestSeqs'] for result in results])
+    sortedsumofeffs_index = argsort(eucsum(alleffs),kind='mergesort')
+    best = max(results,key=lambda result: eucsum(result['bestEs'][:,-1]))
+
+    result = {}
+    result['BestVec'] = best['BestVec']
+    result['bestEs'] = alleffs[:,sortedsumofeffs_index[-numSeqs:]]
+    result['BestSeqs'] = allseqs[:,sortedsumofeffs_index[-numSeqs:]]
+    return result
+
 if __name__ == '__main__':
-    print "Content-Type: text/html"     # HTML is following
-    print                               # blank line, end of headers
+    print("Content-Type: text/html")    # HTML is following
+    print()                             # blank line, end of headers
 
     form = cgi.FieldStorage()
     
     if form.getvalue('source'):
         code = open('evalseqshard.py','rU').read()
-        print '<html><head><style type="text/css">'
-        print HtmlFormatter().get_style_defs('.highlight')
-        print '</style></head><body>'
-        print highlight(code, PythonLexer(), HtmlFormatter())
-        print '</body></html>'
+        print('<html><head><style type="text/css">')
+        print(HtmlFormatter().get_style_defs('.highlight'))
+        print('</style></head><body>')
+        print(highlight(code, PythonLexer(), HtmlFormatter()))
+        print('</body></html>')
         sys.exit()
         
     par = {}
@@ -246,7 +662,7 @@ if __name__ == '__main__':
         par['TrialDuration'] = float(form['TrialDuration'].value)
         par['numSeqs'] = int(form['numSeqs'].value)
     except KeyError:
-        print "something went wrong, didn't get needed fields"
+        print("something went wrong, didn't get needed fields")
         sys.exit()
         
     if form['email'].value != '':
@@ -276,18 +692,18 @@ if __name__ == '__main__':
     for i in range(len(simvec)):
         SimMat[:,:,i]=vec2sim(array(simvec[i]))
 
-    print "<title>Sequence Evaluator Output</title>"
-    print "<h1>Sequence Evaluator Output</h1>"
-    print "<h2>your inputs</h2><small>"
-    print 'parameters: ' , par
-    print '<p>'
-    print 'similarity vectors:' , simvec
-    print "</small><hr><h2>our outputs</h2>"
+    print("<title>Sequence Evaluator Output</title>")
+    print("<h1>Sequence Evaluator Output</h1>")
+    print("<h2>your inputs</h2><small>")
+    print('parameters: ' , par)
+    print('<p>')
+    print('similarity vectors:' , simvec)
+    print("</small><hr><h2>our outputs</h2>")
     result = EvaluateSeqshard(par,SimMat)
     for seqnum in reversed(range(result['bestEs'].shape[1])):
-        print "sequence %d: " % (result['bestEs'].shape[1] - seqnum)
-        print ', '.join(map(str,[int(i) for i in result['BestSeqs'][:,seqnum]]))
-        print '<br>'
-        print "Efficiency: %0.2f" % result['bestEs'][0,seqnum]
-        print '<p>'
+        print("sequence %d: " % (result['bestEs'].shape[1] - seqnum))
+        print(', '.join(map(str,[int(i) for i in result['BestSeqs'][:,seqnum]])))
+        print('<br>')
+        print("Efficiency: %0.2f" % result['bestEs'][0,seqnum])
+        print('<p>')
     
@@ -1,49 +1,64 @@
 #!/usr/bin/env python
 
+# Run with: jittered_timing.py 7 for one participant, or
+# jittered_timing.py 1 30 for participants 1 to 30 across all cores.
+# Timings go into one store; participants already in it are skipped, so an
+# interrupted cohort run can simply be restarted.
+
 import sys
-from os import chdir
-from subprocess import call
 from os.path import exists, join
-import numpy as np
-from mvpa2.base.hdf5 import h5save
-
-if len(sys.argv) > 1:
-    participant = sys.argv[1]
-else:
-    participant = 99
-    print("Generating timing for test participant 99")
+from multiprocessing import Pool, cpu_count
+from random_timing import search_timing, timing_stats, iterations
+from timing_store import (load_store, save_store, append_timing,
+                          contains_participant, import_timing_files)
 
 timing_dir = '/home/nastase/social_actions/scripts/timing'
-sim_dir = join(timing_dir, 'timing_sim_{0}'.format(participant))
+store_fn = join(timing_dir, 'timing_store.npz')
+
+n_processes = cpu_count()
+
 
-chdir(timing_dir)
+def search_participant(participant):
+    """Generate randomized onsets as AFNI's @stim_analyze would, scored in
+    batches, keeping the iteration with the lowest normalized standard
+    deviation; seeds depend only on the participant number"""
+    return (participant,) + search_timing(participant, iterations)
 
-# Run AFNI's @stim_analyze to generate randomized onsets
-if not exists(sim_dir):
-    call('@stim_analyze {0}'.format(participant), shell=True)
-elif exists(sim_dir):
-    print("Simulations already exist for participant {0}".format(participant))
 
-call('sort -n timing_sim_{0}/NSD_sums | head -1'.format(
-        participant), shell=True)
+if __name__ == '__main__':
 
-# Get iteration lowest normalized standard devation
-with open(join(sim_dir, 'NSD_sums')) as f:
-    nsd = {float(line.split()[0]): line.split()[5] for line in f.readlines()}
+    if len(sys.argv) > 2:
+        participants = list(range(int(sys.argv[1]), int(sys.argv[2]) + 1))
+    elif len(sys.argv) > 1:
+        participants = [int(sys.argv[1])]
+    else:
+        participants = [99]
+        print("Generating timing for test participant 99")
 
-min_iter = nsd[min(nsd)].strip(',')
-print("Minimum normalized standard deviation = {0} "
-      "at iteration {1} for participant {2}".format(
-        min(nsd), min_iter, participant))
+    # Start a new store from any timing_final_{p}.hdf5 files already made
+    if exists(store_fn):
+        store = load_store(store_fn)
+    else:
+        store = import_timing_files(load_store(store_fn), timing_dir)
+    todo = [p for p in participants if not contains_participant(store, p)]
+    for participant in sorted(set(participants) - set(todo)):
+        print("Timing for participant {0} already stored, skipping".format(participant))
 
-# Print summary file
-with open(join(sim_dir, 'out.mrt.{0}'.format(min_iter))) as f:
-    print(f.read())
+    # Save as each participant finishes so a restart only redoes the rest
+    pool = Pool(min(n_processes, max(len(todo), 1)))
+    for participant, timing, min_nsd, min_iter, seed in pool.imap_unordered(
+            search_participant, todo):
+        print("Minimum normalized standard deviation = {0} "
+              "at iteration {1} (seed {2}) for participant {3}".format(
+                min_nsd, min_iter, seed, participant))
 
-# Get timing
-with open(join(sim_dir, 'stimes.{0}_01_trial.1D'.format(min_iter))) as f:
-    timing = np.array([[float(onset) for onset in line.split()] for line in f.readlines()])
+        # Print summary
+        print(timing_stats(timing))
 
-assert timing.shape == (8, 103)
+        assert timing.shape == (8, 103)
 
-h5save(join(timing_dir, 'timing_final_{0}.hdf5'.format(participant)), timing)
+        append_timing(store, participant, timing, min_nsd, min_iter, seed)
+        save_store(store, store_fn)
+    pool.close()
+    pool.join()
+    save_store(store, store_fn)
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+# Native replacement for the make_random_timing.py + 3dDeconvolve -nodata
+# loop in @stim_analyze. For each iteration, onsets are drawn under the same
+# constraints (pre-stimulus rest, post-stimulus rest, minimum rest after each
+# stimulus, on a 0.1 s grid) and scored by the normalized standard deviation
+# of the GAM-convolved stimulus regressor, computed directly from (X'X)^-1
+# with per-run Legendre polynomial baselines as 3dDeconvolve does.
+# Candidates are drawn and scored in batches: all regressors of a batch are
+# built as one array and all their X'X matrices inverted together.
+
+import numpy as np
+from scipy.special import eval_legendre
+
+num_runs = 8
+pre_rest = 5      # min rest before first stim (for magnet steady state)
+post_rest = 15    # min rest after last stim (for trailing BOLD response)
+min_rest = 2      # minimum rest after each stimulus
+tr = 1.0
+stim_dur = 2.5
+stim_reps = 103
+run_length = 535
+t_gran = 0.1      # granularity of the extra rest, as in make_random_timing.py
+iterations = 10000
+batchsize = 1000  # candidates drawn and scored together by search_timing
+
+# 3dDeconvolve's automatic baseline order for runs of this length
+polort = 1 + int(run_length / 150)
+
+# AFNI's GAM(p, q) basis, with its default parameters and duration
+gam_p = 8.6
+gam_q = 0.547
+gam_duration = gam_p * gam_q + 4 * np.sqrt(gam_p) * gam_q
+
+
+def extra_rest_units(stim_reps=stim_reps):
+    """Rest beyond the minimums in each run, in units of t_gran"""
+    n_units = int(round((run_length - pre_rest - post_rest -
+                         stim_reps * (stim_dur + min_rest)) / t_gran))
+    assert n_units >= 0
+    return n_units
+
+
+def slot_onsets(slots, stim_reps=stim_reps):
+    """Onsets for events placed at sorted slots among stim_reps events and
+    the extra rest units"""
+    units_before = slots - np.arange(stim_reps)
+    onsets = (int(round(pre_rest / t_gran)) + units_before +
+              np.arange(stim_reps) * int(round((stim_dur + min_rest) / t_gran))) * t_gran
+    return np.round(onsets, 1)
+
+
+def random_onsets(rng, num_runs=num_runs, stim_reps=stim_reps):
+    """Onsets (runs x stim_reps) with the rest beyond the minimums spread
+    uniformly at random over the gaps, in units of t_gran"""
+    n_units = extra_rest_units(stim_reps)
+    onsets = np.zeros((num_runs, stim_reps))
+    for run in range(num_runs):
+        # Order stim_reps events among n_units rest units at random
+        slots = np.sort(rng.choice(stim_reps + n_units, stim_reps, replace=False))
+        onsets[run] = slot_onsets(slots, stim_reps)
+    return onsets
+
+
+def random_onsets_batch(rng, n, num_runs=num_runs, stim_reps=stim_reps):
+    """n timings at once (n x runs x stim_reps), distributed as random_onsets:
+    the events take the slots with the smallest of a row of uniform keys"""
+    n_units = extra_rest_units(stim_reps)
+    keys = rng.random((n, num_runs, stim_reps + n_units))
+    slots = np.sort(np.argpartition(keys, stim_reps - 1, axis=-1)[..., :stim_reps], axis=-1)
+    return slot_onsets(slots, stim_reps)
+
+
+def gam(t):
+    """GAM impulse response (peak 1 at p * q), zero outside [0, duration]"""
+    t = np.asarray(t, dtype=float)
+    response = np.zeros(t.shape)
+    inside = (t > 0) & (t < gam_duration)
+    response[inside] = ((t[inside] / (gam_p * gam_q)) ** gam_p *
+                        np.exp(gam_p - t[inside] / gam_q))
+    return response
+
+
+def baseline(num_runs=num_runs, polort=polort):
+    """Block-diagonal Legendre polynomials up to polort for each run"""
+    n_trs = int(round(run_length / tr))
+    x = np.linspace(-1, 1, n_trs)
+    legendre = np.column_stack([eval_legendre(order, x) for order in range(polort + 1)])
+    return np.kron(np.eye(num_runs), legendre)
+
+
+def regressor(onsets):
+    """GAM-convolved stimulus regressor for onsets (runs x trials), sampled at
+    each TR of the concatenated runs; responses do not cross run boundaries"""
+    n_trs = int(round(run_length / tr))
+    times = np.arange(n_trs) * tr
+    return np.concatenate([gam(times[:, None] - run_onsets[None, :]).sum(axis=1)
+                           for run_onsets in onsets])
+
+
+def regressor_batch(onsets):
+    """regressor for a batch of onsets (n x runs x trials) as one
+    n x runs x TRs array. Onsets lie on the t_gran grid, so each adds one of
+    tr / t_gran tabulated stretches of the GAM to the TRs it reaches, all in
+    one bincount"""
+    n, n_runs, n_trials = onsets.shape
+    n_trs = int(round(run_length / tr))
+    tr_units = int(round(tr / t_gran))
+    n_taps = int(np.ceil(gam_duration / tr)) + 1
+    # Response to an onset phase units before a TR, at that TR and the next
+    table = gam((np.arange(tr_units)[:, None] + np.arange(n_taps) * tr_units) * t_gran)
+    onset_units = np.round(onsets / t_gran).astype(int)
+    first = -(-onset_units // tr_units)
+    phase = first * tr_units - onset_units
+    # Pad each run so responses running past its end are dropped, not wrapped
+    padded = n_trs + n_taps
+    starts = np.arange(n * n_runs).reshape(n, n_runs, 1) * padded + first
+    r = np.bincount((starts[..., None] + np.arange(n_taps)).ravel(),
+                    weights=table[phase].ravel(), minlength=n * n_runs * padded)
+    return r.reshape(n, n_runs, padded)[..., :n_trs]
+
+
+def normalized_sd(onsets, polort=polort):
+    """3dDeconvolve's norm. std. dev. for the stimulus regressor"""
+    X = np.column_stack((baseline(len(onsets), polort), regressor(onsets)))
+    return np.sqrt(np.linalg.inv(X.T.dot(X))[-1, -1])
+
+
+def normalized_sd_batch(onsets, polort=polort):
+    """normalized_sd for a batch of onsets (n x runs x trials), inverting all
+    n X'X matrices at once; the baseline block is shared"""
+    n, n_runs = onsets.shape[:2]
+    legendre = baseline(1, polort)
+    r = regressor_batch(onsets)
+    n_base = n_runs * legendre.shape[1]
+    XtX = np.empty((n, n_base + 1, n_base + 1))
+    XtX[:, :n_base, :n_base] = np.kron(np.eye(n_runs), legendre.T.dot(legendre))
+    XtX[:, :n_base, n_base] = XtX[:, n_base, :n_base] = r.dot(legendre).reshape(n, n_base)
+    XtX[:, n_base, n_base] = np.einsum('ijk,ijk->i', r, r)
+    return np.sqrt(np.linalg.inv(XtX)[:, n_base, n_base])
+
+
+def iteration_seed(participant, iteration):
+    """Seed for an iteration, numbered from 1 as in @stim_analyze"""
+    return participant * 10000 + iteration
+
+
+def batch_seed(participant, batch):
+    """Seed for a batch of iterations, numbered from 0"""
+    return participant * 1000000 + batch
+
+
+def search_timing(participant, iterations=iterations, batchsize=batchsize):
+    """Draw random timings for a participant and keep the one with the lowest
+    normalized standard deviation; returns (onsets, nsd, iteration, seed).
+    With a batchsize, candidates are drawn batchsize at a time from a
+    generator seeded per batch and scored together, and seed is the batch's;
+    otherwise each iteration is seeded as in @stim_analyze."""
+    best = None
+    if not batchsize:
+        for iteration in range(1, iterations + 1):
+            seed = iteration_seed(participant, iteration)
+            onsets = random_onsets(np.random.RandomState(seed))
+            nsd = normalized_sd(onsets)
+            if best is None or nsd < best[1]:
+                best = (onsets, nsd, iteration, seed)
+        return best
+    for batch, start in enumerate(range(0, iterations, batchsize)):
+        seed = batch_seed(participant, batch)
+        onsets = random_onsets_batch(np.random.default_rng(seed),
+                                     min(batchsize, iterations - start))
+        nsd = normalized_sd_batch(onsets)
+        i = np.argmin(nsd)
+        if best is None or nsd[i] < best[1]:
+            best = (onsets[i], nsd[i], start + i + 1, seed)
+    return best
+
+
+def timing_stats(onsets):
+    """Summary of the rest between stimuli, like make_random_timing.py's
+    -show_timing_stats"""
+    rest = np.diff(onsets, axis=1) - stim_dur
+    return ("rest between stimuli: min {0:.1f}, mean {1:.3f}, max {2:.1f}, "
+            "std {3:.3f} s\nfirst onsets {4}\nlast offsets {5}".format(
+                rest.min(), rest.mean(), rest.max(), rest.std(),
+                onsets[:, 0], onsets[:, -1] + stim_dur))
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+# Store for every participant's jittered timing, kept in a single NPZ file
+# with one row per participant: the onsets (runs x trials), their normalized
+# standard deviation, and the iteration and seed they were found at. Legacy
+# timing_final_{p}.hdf5 files can be imported.
+
+import os
+from glob import glob
+import numpy as np
+
+columns = ['participant', 'seed', 'iteration', 'nsd', 'onsets']
+
+
+def new_store():
+    """Empty store: a list per column"""
+    return {column: [] for column in columns}
+
+
+def load_store(store_fn):
+    """Load a store written by save_store, or an empty one if there is none"""
+    store = new_store()
+    if not os.path.exists(store_fn):
+        return store
+    with np.load(store_fn) as saved:
+        for column in columns:
+            store[column] = list(saved[column])
+    return store
+
+
+def save_store(store, store_fn):
+    """Write every column to one NPZ file, replacing it atomically"""
+    tmp_fn = '{0}.{1}'.format(store_fn, os.getpid())
+    with open(tmp_fn, 'wb') as f:
+        np.savez(f, **{column: np.array(store[column]) for column in columns})
+    os.rename(tmp_fn, store_fn)
+
+
+def contains_participant(store, participant):
+    return participant in store['participant']
+
+
+def append_timing(store, participant, onsets, nsd, iteration, seed):
+    """Add a participant's timing, raising ValueError if they already have one"""
+    if contains_participant(store, participant):
+        raise ValueError("Timing for participant {0} is already stored".format(
+            participant))
+    store['participant'].append(participant)
+    store['seed'].append(seed)
+    store['iteration'].append(iteration)
+    store['nsd'].append(nsd)
+    store['onsets'].append(np.asarray(onsets, dtype=float))
+
+
+def participant_timing(store, participant):
+    """A participant's onsets (runs x trials), as saved in timing_final_{p}.hdf5"""
+    if not contains_participant(store, participant):
+        raise KeyError("No timing stored for participant {0}".format(participant))
+    return store['onsets'][store['participant'].index(participant)]
+
+
+def import_timing_files(store, timing_dir):
+    """Append legacy timing_final_{p}.hdf5 files, which record neither NSD
+    (stored as NaN) nor iteration and seed (stored as -1)"""
+    fns = glob(os.path.join(timing_dir, 'timing_final_*.hdf5'))
+    participants = sorted(int(os.path.basename(fn)[len('timing_final_'):-len('.hdf5')])
+                          for fn in fns)
+    if participants:
+        from mvpa2.base.hdf5 import h5load
+    for participant in participants:
+        if contains_participant(store, participant):
+            continue
+        onsets = h5load(os.path.join(timing_dir, 'timing_final_{0}.hdf5'.format(participant)))
+        append_timing(store, participant, onsets, np.nan, -1, -1)
+    return store
@@ -1,15 +1,19 @@
 #!/usr/bin/env python
 
 # Run with: trial_order.py 1 |& tee trial_orders/trial_order_log_1.txt
-# or: for i in {1..30}; do trial_order.py $i |& tee trial_orders/trial_order_log_$i.txt; done
-# If verb selection hangs, try changing seed_increment
+# or for a whole cohort in one process: trial_order.py 1 30
+# (each participant's log goes to trial_orders/trial_order_log_{p}.txt)
+# Trial orders are built as record arrays of (onset, category, stimulus,
+# probe), with stimuli and verbs as indices into lookup tables, and added to
+# trial_orders/trial_orders.npz, which actions_presentation.py reads through
+# experiment/trial_order_store.py
 
 import sys
-from time import time
 from os.path import join
 from copy import deepcopy
+from multiprocessing import Pool, cpu_count
+from io import StringIO
 import numpy as np
-from mvpa2.base.hdf5 import h5load, h5save
 
 base_dir = '/home/nastase/social_actions'
 scripts_dir = join(base_dir, 'scripts')
@@ -17,85 +21,43 @@ exp_dir = join(base_dir, 'experiment')
 stim_dir = join(scripts_dir, 'stimuli')
 seq_dir = join(scripts_dir, 'sequences')
 timing_dir = join(scripts_dir, 'timing')
+trial_order_dir = join(scripts_dir, 'trial_orders')
+sys.path.extend([timing_dir, seq_dir, exp_dir])
+import timing_store
+import design_store
+from trial_order_store import (load_trial_orders, save_trial_orders, add_trial_orders,
+                               trial_list, trial_dtype, fixation, question, special_stimuli)
 
-if len(sys.argv) == 1:
-    participant = 99
-    print "WARNING: Test run with participant set to {0}!".format(participant)
-else:
-    participant = int(sys.argv[1]) 
-
-# Load jittered timing and T1I1 sequences
-timing = h5load(join(timing_dir, 'timing_final_{0}.hdf5'.format(participant)))
-sequence = h5load(join(seq_dir, 'sequence_final_{0}.hdf5'.format(participant)))
-
-assert timing.shape == sequence.shape
-
-categories = {i: [] for i in range(1, 19)}
-with open(join(scripts_dir, 'stimuli.csv')) as f:
-    for line in f.readlines():
-        categories[int(line.split(',')[1])].append(line.strip().split(',')[2])
-
-assert len(categories) == 18
-for stimulus_fns in categories.values():
-    assert len(stimulus_fns) == 5
-
-prep_categories = {i: [] for i in range(1, 19)}
-with open(join(scripts_dir, 'prep_stimuli.csv')) as f:
-    for line in f.readlines():
-        prep_categories[int(line.split(',')[1])].append(line.strip().split(',')[2])
-
-assert len(prep_categories) == 18
-for stimulus_fns in prep_categories.values():
-    assert len(stimulus_fns) == 1
-
-timing_sequence = []
-for run_timing, run_sequence in zip(timing, sequence):
-    timing_sequence.append(np.column_stack((run_timing, run_sequence)).tolist())
-for run_i in range(len(timing_sequence)):
-    for trial_i in range(len(timing_sequence[run_i])):
-        timing_sequence[run_i][trial_i][1] = int(timing_sequence[run_i][trial_i][1]) + 1 
-
-timing_sequence_1 = timing_sequence[:4]
-timing_sequence_2 = timing_sequence[4:]
-assert len(timing_sequence_1) == len(timing_sequence_2) == 4
-
-# Randomly assign stimuli (without replacement) based on conditions
-seed_increment = 0
-for timing_sequence in [timing_sequence_1, timing_sequence_2]:
-    initial_three_first_run = {}
-    final_three = {}
-    for run_i, run in enumerate(timing_sequence):
-        categories_shuffle = deepcopy(categories)
-        
-        for category_id in categories_shuffle.keys():
-            np.random.seed(participant * 1000 +  seed_increment)
-            np.random.shuffle(categories_shuffle[category_id])
-        seed_increment += 1
-
-        for trial_i, trial in enumerate(run):
-            trial_category = trial[1]
-
-            if trial_category == 19:
-                trial.append('fixation')
-                continue
-            elif trial_category == 20:
-                if trial_i == 0:
-                    trial.append('fixation')
-                else:
-                    trial.append('question')
-                continue
-            
-            if trial_i < 3:
-                trial.append(prep_categories[trial_category][0]) 
-            else:
-                trial.append(categories_shuffle[trial_category].pop(0))
+store_fn = join(trial_order_dir, 'trial_orders.npz')
+
+n_processes = cpu_count()
+
+# Verbs from these categories are too alike to serve as each other's foils
+exclusive_categories = ['assembly', 'using']
+
+
+def load_tables():
+    """Read the stimulus, prep stimulus and verb tables shared by everyone,
+    and list all stimulus file names and verbs as lookup tables"""
+    categories = {i: [] for i in range(1, 19)}
+    with open(join(scripts_dir, 'stimuli.csv')) as f:
+        for line in f.readlines():
+            categories[int(line.split(',')[1])].append(line.strip().split(',')[2])
 
-        #assert len(initial_three_first_run) == 3
-        for category_id in categories_shuffle.keys():
-            assert len(categories_shuffle[category_id]) == 0
+    assert len(categories) == 18
+    for stimulus_fns in categories.values():
+        assert len(stimulus_fns) == 5
 
-# Now we insert question probe verbs
-with open(join(scripts_dir, 'verbs.csv')) as f:
+    prep_categories = {i: [] for i in range(1, 19)}
+    with open(join(scripts_dir, 'prep_stimuli.csv')) as f:
+        for line in f.readlines():
+            prep_categories[int(line.split(',')[1])].append(line.strip().split(',')[2])
+
+    assert len(prep_categories) == 18
+    for stimulus_fns in prep_categories.values():
+        assert len(stimulus_fns) == 1
+
+    with open(join(scripts_dir, 'verbs.csv')) as f:
         verbs = {int(line.split(',')[0]):
                     {'category': line.split(',')[1],
                      'sociality': line.split(',')[2],
@@ -103,105 +65,241 @@ with open(join(scripts_dir, 'verbs.csv')) as f:
                      'foils_used': 0}
                  for line in f.readlines()}
 
-for verb_category in verbs.values():
-    assert len(verb_category['verbs']) == 4
+    for verb_category in verbs.values():
+        assert len(verb_category['verbs']) == 4
 
-from copy import deepcopy
-verbs_reference = deepcopy(verbs)
-
-# Change this if verb selection hangs, e.g., to 50
-seed_increment = 50
-start_time = time()
-for sequence_i, timing_sequence in enumerate([timing_sequence_1, timing_sequence_2]):
-    initial_three_first_run = {}
-    final_three = {}
-    for run_i, run in enumerate(timing_sequence):
-        for trial_i, trial in enumerate(run):
-            if trial[2] == 'question':
-                if previous_trial[2] == 'question' or previous_trial[2] == 'fixation':
-                    trial[2] = 'fixation'
-                    print run_i, trial_i, previous_trial, "Switching question to fixation!!!"
-                else:
-                    if run_i > 0 and trial_i <= 2:
-                        correct, foil = final_three[run_i - 1][category_id]
-                        print run_i, trial_i, previous_trial, correct, foil, "Question in first three trials!!!"
-                    elif run_i == 3 and trial_i in range(len(timing_sequence[0]))[-3:]:
-                        assert set(initial_three_first_run[category_id]) <= set(sum([v['verbs'] for v in verbs.values()], []))
-                        correct, foil = initial_three_first_run[category_id]
-                        print run_i, trial_i, previous_trial, correct, foil, "Question in last three trials of last run!!!"
-                    else:
-                        category_id = previous_trial[1]
-                        correct_verbs = verbs[category_id]
-                        np.random.seed(participant * 1000 +  seed_increment)
-                        np.random.shuffle(correct_verbs['verbs'])
-                        if category_id in initial_three_first_run:
-                            if correct_verbs['verbs'][0] in initial_three_first_run[category_id]:
-                                correct = correct_verbs['verbs'].pop(1)
-                        else:
-                            correct = correct_verbs['verbs'].pop(0)
-                        foil_verbs = verbs[np.random.choice(verbs.keys())]
-                        while foil_verbs['category'] == correct_verbs['category'] or foil_verbs['foils_used'] > sequence_i:
-                            foil_verbs = verbs[np.random.choice(verbs.keys())]
-                            if time() - start_time > 5:
-                                raise Exception, ("Got stuck trying to assign verbs "
-                                    " on participant {0}, try a different random seed!!!".format(participant))
-                        if correct_verbs['category'] == 'assembly' or correct_verbs['category'] == 'using':
-                            while foil_verbs['category'] == 'assembly' or foil_verbs['category'] == 'using' or foil_verbs['foils_used'] > sequence_i:
-                                foil_verbs = verbs[np.random.choice(verbs.keys())]
-                                if time() - start_time > 5:
-                                    raise Exception, ("Got stuck trying to assign verbs "
-                                        " on participant {0}, try a different random seed!!!".format(participant))
-                        foil_verbs['foils_used'] += 1
-                        np.random.seed(participant * 10000 +  seed_increment)
-                        np.random.shuffle(foil_verbs['verbs'])
-                        if category_id in initial_three_first_run:
-                            if foil_verbs['verbs'][0] in initial_three_first_run[category_id]:
-                                foil = foil_verbs['verbs'].pop(1)
-                        else:
-                            foil = foil_verbs['verbs'].pop(0)
-
-                        if run_i == 0 and trial_i < 3:
-                            initial_three_first_run[category_id] = [correct, foil]
-                            print run_i, trial_i, previous_trial, "Grabbing question in first three trials of first run!!!"
-                        elif trial_i in range(len(timing_sequence[0]))[-3:]:
-                            if run_i not in final_three.keys():
-                                final_three.update({run_i: {}})
-                            final_three[run_i].update({category_id: [correct, foil]})
-                            print run_i, trial_i, previous_trial, "Grabbing question in final three trials!!!"
-                        
-                        print run_i, trial_i, previous_trial, correct, correct_verbs['category'], foil, foil_verbs['category']
-
-                    assert trial[2] == 'question'
-                    probe = [correct, foil]
-                    np.random.shuffle(probe)
-                    trial.append(probe)
-    
-            previous_trial = trial      
+    stimuli = special_stimuli + sorted(set(sum(categories.values(), []) +
+                                           sum(prep_categories.values(), [])))
+    verb_names = [verb for category_id in sorted(verbs.keys())
+                  for verb in verbs[category_id]['verbs']]
+    assert len(verb_names) == len(set(verb_names))
+
+    return categories, prep_categories, verbs, stimuli, verb_names
+
+
+def assign_stimuli(participant, timing, sequence, categories, prep_categories):
+    """Pair onsets with categories and randomly assign stimuli (without
+    replacement) based on conditions; returns the two sessions' runs as
+    runs x trials record arrays"""
+    records = np.zeros(timing.shape, dtype=trial_dtype)
+    records['onset'] = timing
+    records['category'] = np.asarray(sequence, dtype=int) + 1
+    records['probe'] = -1
+
+    sessions = [records[:4], records[4:]]
+    assert len(sessions[0]) == len(sessions[1]) == 4
+
+    seed_increment = 0
+    for session in sessions:
+        for run in session:
+            categories_shuffle = deepcopy(categories)
+
+            for category_id in categories_shuffle.keys():
+                rng = np.random.RandomState(participant * 1000 + seed_increment)
+                rng.shuffle(categories_shuffle[category_id])
             seed_increment += 1
 
-for i, j in zip(verbs.values(), verbs_reference.values()):
-    print i['foils_used'], len(i['verbs']), i['verbs'], j['verbs']
-
-# Run some tests
-verbs_used = []
-for s in [timing_sequence_1, timing_sequence_2]:
-    question_count = 0
-    for r in s:
-        for t in r[3:]:
-            if t[2] == 'question':
-                question_count += 1
-                verbs_used.extend(t[3])
-    assert question_count == 18
-assert len(verbs_used) == len(np.unique(verbs_used)) == 18*4
-
-for verb_category in verbs.values():
-    assert verb_category['foils_used'] == 2
-    assert len(verb_category['verbs']) == 0
-
-for sequence_i, timing_sequence in enumerate([timing_sequence_1, timing_sequence_2]):
-    for run_i, run in enumerate(timing_sequence):
-        h5save(join(scripts_dir, 'trial_orders',
-                    'trial_order_p{0}_s{1}_r{2}.hdf5'.format(
-                         participant, sequence_i + 1, run_i + 1)), run)
-
-print "Successfully finished creating trial order"
+            run['stimulus'][run['category'] == 19] = fixation
+            run['stimulus'][run['category'] == 20] = question
+            if run['category'][0] == 20:
+                run['stimulus'][0] = fixation
+
+            # Prep clips in the first three trials, shuffled clips after
+            for category_id in categories_shuffle.keys():
+                trials = np.flatnonzero(run['category'] == category_id)
+                run['stimulus'][trials[trials < 3]] = stimulus_index[prep_categories[category_id][0]]
+                assert np.sum(trials >= 3) == len(categories_shuffle[category_id])
+                run['stimulus'][trials[trials >= 3]] = [stimulus_index[stimulus_fn] for stimulus_fn
+                                                        in categories_shuffle[category_id]]
+
+    return sessions
+
+
+def allowed_foil(correct_verbs, foil_verbs):
+    """Whether foil_verbs' category can supply the foil for a question about
+    a clip from correct_verbs' category"""
+    if foil_verbs['category'] == correct_verbs['category']:
+        return False
+    return not (correct_verbs['category'] in exclusive_categories and
+                foil_verbs['category'] in exclusive_categories)
+
+
+def match_foils(question_ids, capacities, verbs, rng):
+    """Pick a foil category for each question (given by the category of its
+    clip) as a bipartite matching, using each foil category at most its
+    capacity; augmenting paths (Kuhn's algorithm) find a complete assignment
+    in one pass whenever one exists, trying candidates in a seeded order"""
+    slots = [foil_id for foil_id in sorted(capacities)
+             for copy in range(capacities[foil_id])]
+    candidates = []
+    for question_id in question_ids:
+        allowed = [slot for slot, foil_id in enumerate(slots)
+                   if allowed_foil(verbs[question_id], verbs[foil_id])]
+        rng.shuffle(allowed)
+        candidates.append(allowed)
+    slot_question = {}
+
+    def augment(question, visited):
+        for slot in candidates[question]:
+            if slot in visited:
+                continue
+            visited.add(slot)
+            if slot not in slot_question or augment(slot_question[slot], visited):
+                slot_question[slot] = question
+                return True
+        return False
+
+    for question in range(len(question_ids)):
+        if not augment(question, set()):
+            raise ValueError("No foil assignment satisfies the constraints for "
+                             "question categories {0}".format(question_ids))
+    foils = [None] * len(question_ids)
+    for slot, question in slot_question.items():
+        foils[question] = slots[slot]
+    return foils
+
+
+def assign_verbs(participant, sessions, verbs):
+    """Insert question probe verbs, using up the participant's copy of verbs"""
+
+    # Seed for verb order, foil matching and probe order
+    verb_seed = participant * 1000 + 50
+    rng = np.random.RandomState(verb_seed)
+    for category_id in sorted(verbs.keys()):
+        rng.shuffle(verbs[category_id]['verbs'])
+
+    for sequence_i, session in enumerate(sessions):
+        n_runs, n_trials = session.shape
+
+        # Find questions: those in the first three trials of a run repeat the
+        # last three trials of the previous run (the first run's are repeated
+        # at the end of the last run), so they reuse the original's verbs
+        questions, repeats = [], []
+        for run_i, trial_i in zip(*np.nonzero(session['stimulus'] == question)):
+            previous_trial = session.ravel()[run_i * n_trials + trial_i - 1]
+            position = (run_i, trial_i)
+            if previous_trial['stimulus'] in (question, fixation):
+                session['stimulus'][position] = fixation
+                print(run_i, trial_i, describe(previous_trial), "Switching question to fixation!!!")
+            elif run_i > 0 and trial_i <= 2:
+                repeats.append((position, (run_i - 1, n_trials - 3 + trial_i)))
+                print(run_i, trial_i, describe(previous_trial), "Question in first three trials!!!")
+            elif run_i == n_runs - 1 and trial_i >= n_trials - 3:
+                repeats.append((position, (0, trial_i - (n_trials - 3))))
+                print(run_i, trial_i, describe(previous_trial), "Question in last three trials of last run!!!")
+            else:
+                questions.append((position, previous_trial))
+
+        # Each category supplies at most sequence_i + 1 foils so far, leaving
+        # enough verbs for its own questions in this sequence
+        question_ids = [int(clip['category']) for position, clip in questions]
+        capacities = {}
+        for category_id in verbs:
+            capacities[category_id] = max(0, min(
+                sequence_i + 1 - verbs[category_id]['foils_used'],
+                len(verbs[category_id]['verbs']) - question_ids.count(category_id)))
+        foil_ids = match_foils(question_ids, capacities, verbs, rng)
+
+        pairs = {}
+        for (position, clip), foil_id in zip(questions, foil_ids):
+            category_id = int(clip['category'])
+            correct = verbs[category_id]['verbs'].pop(0)
+            foil = verbs[foil_id]['verbs'].pop(0)
+            verbs[foil_id]['foils_used'] += 1
+            pairs[position] = [correct, foil]
+            print(position[0], position[1], describe(clip), correct, verbs[category_id]['category'], foil, verbs[foil_id]['category'])
+
+        for position, original in ([(position, position) for position, clip in questions] +
+                                   repeats):
+            assert session['stimulus'][position] == question
+            if original not in pairs:
+                raise ValueError("Repeated question has no original question at "
+                                 "run {0} trial {1}".format(*original))
+            probe = list(pairs[original])
+            rng.shuffle(probe)
+            session['probe'][position] = [verb_index[verb] for verb in probe]
+
+
+def describe(record):
+    """A trial record as [onset, category, stimulus] for the log"""
+    return trial_list([record], stimuli, verb_names)[0]
+
+
+def check_trial_order(sessions, verbs, verbs_reference):
+    """Run some tests: every verb used once, 18 questions per session and
+    two foils per verb category"""
+    for i, j in zip(verbs.values(), verbs_reference.values()):
+        print(i['foils_used'], len(i['verbs']), i['verbs'], j['verbs'])
+
+    verbs_used = []
+    for session in sessions:
+        assert np.all(session['probe'][session['stimulus'] != question] == -1)
+        questions = session[:, 3:][session[:, 3:]['stimulus'] == question]
+        assert len(questions) == 18
+        verbs_used.extend(questions['probe'].ravel())
+    assert len(verbs_used) == len(np.unique(verbs_used)) == 18*4
+
+    for verb_category in verbs.values():
+        assert verb_category['foils_used'] == 2
+        assert len(verb_category['verbs']) == 0
+
+
+def make_trial_order(participant):
+    """Both sessions' runs for a participant, from the shared tables and the
+    participant's timing and sequences"""
+    assert timings[participant].shape == sequences[participant].shape
+    verbs = deepcopy(verbs_reference)
+    sessions = assign_stimuli(participant, timings[participant],
+                              sequences[participant], categories, prep_categories)
+    assign_verbs(participant, sessions, verbs)
+    check_trial_order(sessions, verbs, verbs_reference)
+    return sessions
+
+
+def make_logged_trial_order(participant):
+    """make_trial_order in a worker process, returning its log with the result"""
+    stdout = sys.stdout
+    sys.stdout = log = StringIO()
+    try:
+        sessions = make_trial_order(participant)
+    finally:
+        sys.stdout = stdout
+    return participant, sessions, log.getvalue()
+
+
+# Load the tables, timing and sequences once; worker processes share them
+categories, prep_categories, verbs_reference, stimuli, verb_names = load_tables()
+stimulus_index = {stimulus_fn: i for i, stimulus_fn in enumerate(stimuli)}
+verb_index = {verb: i for i, verb in enumerate(verb_names)}
+timings = timing_store.load_store(join(timing_dir, 'timing_store.npz'))
+timings = dict(zip(timings['participant'], timings['onsets']))
+sequences = design_store.load_store(join(seq_dir, 'sequence_designs.npz'))
+sequences = {participant: design_store.participant_runs(sequences, participant)
+             for participant in set(sequences['participant'])}
+
+if __name__ == '__main__':
+
+    if len(sys.argv) == 1:
+        participants = [99]
+        print("WARNING: Test run with participant set to {0}!".format(participants[0]))
+    elif len(sys.argv) == 2:
+        participants = [int(sys.argv[1])]
+    else:
+        participants = range(int(sys.argv[1]), int(sys.argv[2]) + 1)
+
+    trial_orders = load_trial_orders(store_fn, stimuli, verb_names)
+    if len(participants) == 1:
+        add_trial_orders(trial_orders, participants[0], make_trial_order(participants[0]),
+                         stimuli, verb_names)
+    else:
+        pool = Pool(min(n_processes, len(participants)))
+        for participant, sessions, log in pool.imap(make_logged_trial_order, participants):
+            with open(join(trial_order_dir, 'trial_order_log_{0}.txt'.format(participant)), 'w') as f:
+                f.write(log)
+            add_trial_orders(trial_orders, participant, sessions, stimuli, verb_names)
+            print("Participant {0} done".format(participant))
+        pool.close()
+        pool.join()
+    save_trial_orders(trial_orders, store_fn)
+
+    print("Successfully finished creating trial order")